@@ -1,36 +1,26 @@
-"""Flask app with Telegram webhook and mail checker."""
+"""aiohttp app with Telegram webhook and mail checker."""
 import asyncio
+import hmac
 import logging
-import random
-import threading
-import time
-from queue import Queue
+import os
+import socket
+import uuid
+from datetime import timedelta
 
-from flask import Flask, request, jsonify
+import orjson
+from aiohttp import web
 from telegram import Update
-from telegram.error import RetryAfter
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler
 
 import config
 import db
-from bot.handlers import (
-    cmd_start,
-    cmd_help,
-    callback_create_mail,
-    callback_my_mail,
-    callback_refresh,
-    callback_new_mail,
-    callback_delete_mail,
-    callback_home,
-    CB_CREATE_MAIL,
-    CB_MY_MAIL,
-    CB_REFRESH,
-    CB_NEW_MAIL,
-    CB_DELETE_MAIL,
-    CB_HOME,
-)
+from bot.handlers import cmd_start, cmd_help, callback_dispatch
+from bot.mail_service import close_client
+from bot.media_style import load_gif_cache
 from bot.sse_listener import run_mail_checker
-from bot.sender import run_sender_thread
+from bot.sender import run_sender
+from bot.update_processor import PerChatUpdateProcessor
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -39,134 +29,219 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 MAX_WEBHOOK_PAYLOAD = 64 * 1024  # 64 KB
+_WEBHOOK_RETRY_MAX = 60  # cap on the backoff between set_webhook attempts, seconds
+_WEBHOOK_LEASE_TTL = 90  # a registering worker that dies hands over after this long
+_WEBHOOK_LEASE_WAIT = 15  # how often the other workers check on the registration
+# Created once per gunicorn master (the app is preloaded): every worker it forks,
+# replacements included, shares it, so the webhook is registered once per deploy
+_RUN_ID = uuid.uuid4().hex
 
-# Flask app
-app = Flask(__name__)
-
-# Telegram bot application
-tg_application: Application | None = None
-message_queue: Queue | None = None
-
-# Persistent event loop for PTB
-_ptb_loop: asyncio.AbstractEventLoop | None = None
-_ptb_loop_thread: threading.Thread | None = None
+_SECRET_BYTES = config.WEBHOOK_SECRET.encode()
 
+# Pre-encoded webhook replies: no JSON work per request
+_OK_BODY = b'{"ok":true}'
+_FAIL_BODY = b'{"ok":false}'
 
-def _run_ptb_loop():
-    global _ptb_loop
-    _ptb_loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(_ptb_loop)
-    _ptb_loop.run_forever()
+# Commands we register handlers for; other messages are dropped unparsed
+_COMMANDS = frozenset(("start", "help"))
 
+# Bot API payloads are small; never let Nagle hold them back
+_TG_SOCKET_OPTIONS = ((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),)
 
-def _run_async(coro):
-    future = asyncio.run_coroutine_threadsafe(coro, _ptb_loop)
-    return future.result()
+# Telegram bot application (lives on the aiohttp event loop)
+tg_application: Application | None = None
+message_queue: asyncio.Queue | None = None
+_sender_task: asyncio.Task | None = None
+_checker_task: asyncio.Task | None = None
+_webhook_task: asyncio.Task | None = None
 
 
 def build_application() -> Application:
     application = (
         Application.builder()
         .token(config.TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(config.MAX_CONCURRENT_UPDATES))
+        .socket_options(_TG_SOCKET_OPTIONS)
         .build()
     )
 
     application.add_handler(CommandHandler("start", cmd_start))
     application.add_handler(CommandHandler("help", cmd_help))
-    application.add_handler(CallbackQueryHandler(callback_create_mail, pattern=CB_CREATE_MAIL))
-    application.add_handler(CallbackQueryHandler(callback_my_mail, pattern=CB_MY_MAIL))
-    application.add_handler(CallbackQueryHandler(callback_refresh, pattern=CB_REFRESH))
-    application.add_handler(CallbackQueryHandler(callback_new_mail, pattern=CB_NEW_MAIL))
-    application.add_handler(CallbackQueryHandler(callback_delete_mail, pattern=CB_DELETE_MAIL))
-    application.add_handler(CallbackQueryHandler(callback_home, pattern=CB_HOME))
+    application.add_handler(CallbackQueryHandler(callback_dispatch))
 
     return application
 
 
-def init_bot():
-    global tg_application, message_queue, _ptb_loop_thread
+async def init_bot(app: web.Application):
+    global tg_application, message_queue, _sender_task, _checker_task, _webhook_task
 
     db.init_db()
-
-    _ptb_loop_thread = threading.Thread(target=_run_ptb_loop, daemon=True)
-    _ptb_loop_thread.start()
-    time.sleep(0.1)
+    load_gif_cache()
 
     tg_application = build_application()
     application = tg_application
 
-    _run_async(application.initialize())
-
-    message_queue = Queue()
-    run_sender_thread(message_queue, config.TELEGRAM_BOT_TOKEN)
-
-    def on_new_message(user_id: str, msg_id: str, parsed: dict):
-        message_queue.put((user_id, parsed))
-
-    run_mail_checker(on_new_message)
-
-    if config.WEBHOOK_URL:
-        webhook_url = f"{config.WEBHOOK_URL}/webhook"
-        # Stagger set_webhook to avoid Telegram flood when multiple workers start
-        time.sleep(random.uniform(0, 2))
-        for attempt in range(3):
-            try:
-                _run_async(application.bot.set_webhook(
-                    url=webhook_url,
-                    secret_token=config.WEBHOOK_SECRET,
-                ))
-                logger.info("Webhook set: %s", webhook_url)
-                break
-            except RetryAfter as e:
-                if attempt < 2:
-                    delay = e.retry_after + 0.5
-                    logger.warning("Telegram flood limit, retry in %.0fs", delay)
-                    time.sleep(delay)
-                else:
-                    logger.exception("Webhook set failed after retries: %s", e)
-                    raise
-    else:
-        logger.warning("WEBHOOK_URL not set - webhook mode disabled")
+    await application.initialize()
+    await application.start()
 
+    loop = asyncio.get_running_loop()
+    message_queue = asyncio.Queue()
+    _sender_task = loop.create_task(run_sender(message_queue, application.bot))
+    _checker_task = loop.create_task(run_mail_checker(message_queue))
 
-@app.route("/")
-def index():
-    return jsonify({"status": "ok", "bot": "TemperMail"})
-
-
-@app.route("/webhook", methods=["POST"])
-def webhook():
+    if not config.WEBHOOK_URL:
+        logger.warning("WEBHOOK_URL not set - webhook mode disabled")
+    elif config.WEBHOOK_REGISTER:
+        # Register in the background so worker startup doesn't wait on Telegram;
+        # every worker starts this, the DB lease lets exactly one of them call set_webhook
+        _webhook_task = loop.create_task(_register_webhook(application))
+
+
+async def _register_webhook(application: Application):
+    """
+    set_webhook until it succeeds: until then Telegram keeps the previous secret,
+    so every update would be rejected. Workers share the job through a DB lease;
+    if its holder dies, another worker takes over once the lease expires.
+    """
+    webhook_url = f"{config.WEBHOOK_URL}/webhook"
+    owner = os.getpid()
+    delay = 1.0
+    while True:
+        try:
+            status = await asyncio.to_thread(
+                db.claim_webhook_registration, _RUN_ID, owner, _WEBHOOK_LEASE_TTL
+            )
+        except Exception as e:
+            logger.warning("Webhook lease check failed, retry in %ds: %s", _WEBHOOK_LEASE_WAIT, e)
+            await asyncio.sleep(_WEBHOOK_LEASE_WAIT)
+            continue
+        if status == "done":
+            return
+        if status == "failed":
+            logger.error("Webhook registration failed permanently; no worker will retry until "
+                         "the service restarts, and Telegram updates will be rejected")
+            return
+        if status == "pending":
+            await asyncio.sleep(_WEBHOOK_LEASE_WAIT)
+            continue
+
+        try:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=config.WEBHOOK_SECRET,
+            )
+        except RetryAfter as e:
+            wait = e.retry_after
+            if isinstance(wait, timedelta):
+                wait = wait.total_seconds()
+            logger.warning("Telegram flood limit, retry in %.0fs", wait + 0.5)
+            await asyncio.sleep(wait + 0.5)
+            continue
+        except BadRequest as e:
+            # A NetworkError subclass, but a rejected URL/certificate won't fix itself
+            await _give_up_webhook(f"rejected: {e}")
+            return
+        except NetworkError as e:
+            # Includes TimedOut: transient, keep trying with capped backoff
+            logger.warning("Webhook set failed, retry in %.0fs: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _WEBHOOK_RETRY_MAX)
+            continue
+        except Exception as e:
+            # Bad token/URL: retrying won't help
+            await _give_up_webhook(f"failed: {e!r}")
+            return
+        logger.info("Webhook set: %s", webhook_url)
+        await asyncio.to_thread(db.finish_webhook_registration, _RUN_ID, "done")
+        return
+
+
+async def _give_up_webhook(reason: str):
+    """Record a permanent set_webhook failure so the other workers stop waiting on it."""
+    logger.error("Webhook set %s. No worker will retry until the service restarts; "
+                 "Telegram updates will be rejected until then", reason)
+    await asyncio.to_thread(db.finish_webhook_registration, _RUN_ID, "failed")
+
+
+async def shutdown_bot(app: web.Application):
+    for task in (_checker_task, _sender_task, _webhook_task):
+        if task:
+            task.cancel()
+    if tg_application:
+        await tg_application.stop()
+        await tg_application.shutdown()
+    await close_client()
+
+
+def _wants_update(data: dict) -> bool:
+    """Cheap shape check so irrelevant updates skip Update.de_json entirely."""
+    if "callback_query" in data:
+        # Unknown callback data still reaches callback_dispatch to be answered
+        return True
+    # CommandHandler's default filter (UpdateType.MESSAGES) takes edited commands too
+    message = data.get("message") or data.get("edited_message")
+    if not isinstance(message, dict):
+        return False
+    text = message.get("text")
+    if not isinstance(text, str) or not text.startswith("/"):
+        return False
+    command = text.split(maxsplit=1)[0][1:].partition("@")[0]
+    return command in _COMMANDS
+
+
+def _reply(body: bytes, status: int = 200) -> web.Response:
+    return web.Response(body=body, status=status, content_type="application/json")
+
+
+async def index(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok", "bot": "TemperMail"})
+
+
+async def webhook(request: web.Request) -> web.Response:
     if not tg_application:
-        return jsonify({"ok": False}), 500
+        return _reply(_FAIL_BODY, 500)
 
-    # Validate secret token (Telegram sends it in this header)
-    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
-    if token != config.WEBHOOK_SECRET:
-        return jsonify({"ok": False}), 403
+    headers = request.headers
 
-    # Reject oversized payloads
-    if request.content_length and request.content_length > MAX_WEBHOOK_PAYLOAD:
-        return jsonify({"ok": False}), 413
+    # Validate secret token (Telegram sends it in this header), constant-time
+    token = headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+    if not hmac.compare_digest(token, _SECRET_BYTES):
+        return _reply(_FAIL_BODY, 403)
 
-    # Require JSON content type
-    if not request.is_json:
-        return jsonify({"ok": False}), 415
+    # Reject oversized payloads and non-JSON bodies before reading anything
+    content_length = request.content_length
+    if content_length and content_length > MAX_WEBHOOK_PAYLOAD:
+        return _reply(_FAIL_BODY, 413)
+    if not headers.get("Content-Type", "").startswith("application/json"):
+        return _reply(_FAIL_BODY, 415)
+
+    try:
+        data = orjson.loads(await request.read())
+    except orjson.JSONDecodeError:
+        return _reply(_FAIL_BODY, 400)
+    if not data or not isinstance(data, dict):
+        return _reply(_FAIL_BODY, 400)
+    if not _wants_update(data):
+        return _reply(_OK_BODY)
 
     try:
-        data = request.get_json(silent=True)
-        if not data:
-            return jsonify({"ok": False}), 400
         update = Update.de_json(data, tg_application.bot)
-        _run_async(tg_application.process_update(update))
-        return jsonify({"ok": True})
+        # Ack right away; PTB processes the update in the background
+        await tg_application.update_queue.put(update)
+        return _reply(_OK_BODY)
     except Exception as e:
         logger.exception("Webhook error: %s", e)
-        return jsonify({"ok": False}), 500
+        return _reply(_FAIL_BODY, 500)
+
 
+app = web.Application(client_max_size=MAX_WEBHOOK_PAYLOAD)
+app.router.add_get("/", index)
+app.router.add_post("/webhook", webhook)
 
-# Initialize on module load (for gunicorn/Railway)
+# Initialize on worker startup (for gunicorn/Railway)
 if config.TELEGRAM_BOT_TOKEN:
-    init_bot()
+    app.on_startup.append(init_bot)
+    app.on_cleanup.append(shutdown_bot)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=config.PORT)
+    web.run_app(app, port=config.PORT)
@@ -1,6 +1,7 @@
 """Telegram bot handlers."""
+import asyncio
 import logging
-from datetime import datetime, timezone
+import time
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
@@ -9,8 +10,9 @@ import db
 from config import SESSION_MAX_AGE_SECONDS
 from bot.mail_service import create_account, get_messages, get_message_detail
 from bot.media_style import send_message_with_gif
-from bot.message_parser import get_button_label, parse_message
+from bot.message_parser import parse_message
 from bot.rate_limiter import is_allowed
+from bot.sender import MAX_MAILS_PER_MESSAGE, pack_mails, send_messages
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +23,8 @@ CB_NEW_MAIL = "new_mail"
 CB_DELETE_MAIL = "delete_mail"
 CB_HOME = "home"
 
+_MAX_DETAIL_FETCHES = 8  # concurrent mail.tm detail requests per refresh
+
 HELP_TEXT = (
     "<b>Бот для временной почты 😎</b>\n\n"
     "Когда не хочется оставлять основную почту на каждом сайте, временный ящик очень выручает.\n\n"
@@ -29,67 +33,52 @@ HELP_TEXT = (
 )
 
 
-def _kb_no_mail() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📬 Создать почту", callback_data=CB_CREATE_MAIL)],
-        [InlineKeyboardButton("🏠 Домой", callback_data=CB_HOME)],
-    ])
-
-
-def _kb_active() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("📫 Мой ящик", callback_data=CB_MY_MAIL),
-            InlineKeyboardButton("🔄 Проверить", callback_data=CB_REFRESH),
-        ],
-        [InlineKeyboardButton("🗑 Удалить почту", callback_data=CB_DELETE_MAIL)],
-        [InlineKeyboardButton("🏠 Домой", callback_data=CB_HOME)],
-    ])
-
-
-def _kb_expired() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("♻️ Новый ящик", callback_data=CB_NEW_MAIL)],
-        [InlineKeyboardButton("🏠 Домой", callback_data=CB_HOME)],
-    ])
-
-
-def _parse_created_at(created_at: str) -> datetime | None:
-    try:
-        dt = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt
-    except Exception:
-        return None
-
-
-def _is_session_expired(created_at: str) -> bool:
-    dt = _parse_created_at(created_at)
-    if dt is None:
-        return True
-    age = (datetime.now(timezone.utc) - dt).total_seconds()
-    return age > SESSION_MAX_AGE_SECONDS
+# Keyboards are immutable PTB objects, so build them once and share
+_KB_NO_MAIL = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📬 Создать почту", callback_data=CB_CREATE_MAIL)],
+    [InlineKeyboardButton("🏠 Домой", callback_data=CB_HOME)],
+])
+
+_KB_ACTIVE = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📫 Мой ящик", callback_data=CB_MY_MAIL),
+        InlineKeyboardButton("🔄 Проверить", callback_data=CB_REFRESH),
+    ],
+    [InlineKeyboardButton("🗑 Удалить почту", callback_data=CB_DELETE_MAIL)],
+    [InlineKeyboardButton("🏠 Домой", callback_data=CB_HOME)],
+])
+
+_KB_EXPIRED = InlineKeyboardMarkup([
+    [InlineKeyboardButton("♻️ Новый ящик", callback_data=CB_NEW_MAIL)],
+    [InlineKeyboardButton("🏠 Домой", callback_data=CB_HOME)],
+])
+
+
+def _session_state(session: dict | None) -> tuple[str, str]:
+    """
+    Classify a session in one pass.
+    Returns (state, ttl) where state is "none", "active" or "expired"
+    and ttl is the remaining lifetime text for active sessions.
+    """
+    if not session:
+        return "none", ""
+    remaining = SESSION_MAX_AGE_SECONDS - (time.time() - session["created_at"])
+    if remaining < 0:
+        return "expired", ""
+    mins = int(remaining // 60)
+    return "active", f"{mins} мин"
 
 
-def _remaining_ttl(created_at: str) -> str:
-    dt = _parse_created_at(created_at)
-    if dt is None:
-        return "непонятно сколько"
-    remaining = SESSION_MAX_AGE_SECONDS - (datetime.now(timezone.utc) - dt).total_seconds()
-    if remaining <= 0:
-        return "время вышло"
-    mins = int(remaining // 60)
-    return f"{mins} мин"
+_KEYBOARDS = {
+    "none": _KB_NO_MAIL,
+    "active": _KB_ACTIVE,
+    "expired": _KB_EXPIRED,
+}
 
 
-def _keyboard_for_user(user_id: str) -> InlineKeyboardMarkup:
-    session = db.get_session(user_id)
-    if not session:
-        return _kb_no_mail()
-    if _is_session_expired(session["created_at"]):
-        return _kb_expired()
-    return _kb_active()
+def _keyboard_for_user(user_id: int) -> InlineKeyboardMarkup:
+    state, _ = _session_state(db.get_session(user_id))
+    return _KEYBOARDS[state]
 
 
 async def _safe_delete_message(bot, chat_id: str | int, message_id: int | None):
@@ -104,7 +93,7 @@ async def _safe_delete_message(bot, chat_id: str | int, message_id: int | None):
 async def _send_page(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
-    user_id: str,
+    user_id: int,
     tag: str,
     text: str,
     reply_markup=None,
@@ -135,12 +124,27 @@ async def _send_page(
         db.set_last_ui_message_id(user_id, msg.message_id)
 
 
-async def _rate_check(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str) -> bool:
-    """Return True if request is throttled (caller should return early)."""
-    user_id = str(update.effective_user.id)
+async def _rate_check(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    action: str,
+) -> bool:
+    """
+    Return True if request is throttled (caller should return early).
+    Callbacks must call this before answering the query: a denied callback
+    is answered with an alert only, without sending anything to the chat.
+    """
     if is_allowed(user_id, action):
         return False
 
+    if update.callback_query:
+        await update.callback_query.answer(
+            "Слишком много запросов. Небольшая пауза и продолжаем.",
+            show_alert=True,
+        )
+        return True
+
     await _send_page(
         update,
         context,
@@ -148,18 +152,13 @@ async def _rate_check(update: Update, context: ContextTypes.DEFAULT_TYPE, action
         "rate_limited",
         "Немного быстрее, чем нужно 🙂\n\n<blockquote>Подожди пару секунд и попробуй снова.</blockquote>",
     )
-    if update.callback_query:
-        await update.callback_query.answer(
-            "Слишком много запросов. Небольшая пауза и продолжаем.",
-            show_alert=True,
-        )
     return True
 
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await _rate_check(update, context, "general"):
+    user_id = update.effective_user.id
+    if await _rate_check(update, context, user_id, "general"):
         return
-    user_id = str(update.effective_user.id)
     await _send_page(
         update,
         context,
@@ -171,9 +170,9 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await _rate_check(update, context, "general"):
+    user_id = update.effective_user.id
+    if await _rate_check(update, context, user_id, "general"):
         return
-    user_id = str(update.effective_user.id)
     await _send_page(
         update,
         context,
@@ -186,13 +185,13 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def callback_create_mail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    if await _rate_check(update, context, "create_mail"):
+    user_id = update.effective_user.id
+    if await _rate_check(update, context, user_id, "create_mail"):
         return
-    user_id = str(update.effective_user.id)
+    await query.answer()
 
     try:
-        email, token, account_id = create_account()
+        email, token, account_id = await create_account()
         db.save_session(user_id, email, token, account_id)
         await _send_page(
             update,
@@ -201,7 +200,7 @@ async def callback_create_mail(update: Update, context: ContextTypes.DEFAULT_TYP
             "create_success",
             f"Готово, держи адрес:\n<code>{email}</code>\n\n"
             "<blockquote>Используй его для регистраций, а основную почту оставь для важных дел.</blockquote>",
-            reply_markup=_kb_active(),
+            reply_markup=_KB_ACTIVE,
         )
     except Exception as e:
         logger.exception("create_account failed: %s", e)
@@ -212,41 +211,41 @@ async def callback_create_mail(update: Update, context: ContextTypes.DEFAULT_TYP
             "create_error",
             "Не получилось создать ящик с первого раза.\n\n"
             "<blockquote>Попробуй еще раз через минуту.</blockquote>",
-            reply_markup=_kb_no_mail(),
+            reply_markup=_KB_NO_MAIL,
         )
 
 
 async def callback_my_mail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    if await _rate_check(update, context, "general"):
+    user_id = update.effective_user.id
+    if await _rate_check(update, context, user_id, "general"):
         return
-    user_id = str(update.effective_user.id)
+    await query.answer()
 
     session = db.get_session(user_id)
-    if not session:
+    state, ttl = _session_state(session)
+    if state == "none":
         await _send_page(
             update,
             context,
             user_id,
             "no_mail",
             "Пока нет активной почты.\n\n<blockquote>Нажми «📬 Создать почту», и всё будет готово.</blockquote>",
-            reply_markup=_kb_no_mail(),
+            reply_markup=_KB_NO_MAIL,
         )
         return
 
-    if _is_session_expired(session["created_at"]):
+    if state == "expired":
         await _send_page(
             update,
             context,
             user_id,
             "expired",
             "Срок жизни этой почты закончился.\n\n<blockquote>Можно сразу создать новый ящик.</blockquote>",
-            reply_markup=_kb_expired(),
+            reply_markup=_KB_EXPIRED,
         )
         return
 
-    ttl = _remaining_ttl(session["created_at"])
     await _send_page(
         update,
         context,
@@ -254,55 +253,90 @@ async def callback_my_mail(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "my_mail",
         f"Твой ящик:\n<code>{session['email']}</code>\n\n"
         f"<blockquote>Осталось жить: {ttl}</blockquote>",
-        reply_markup=_kb_active(),
+        reply_markup=_KB_ACTIVE,
     )
 
 
+def _start_detail_fetches(token: str, msg_ids: list[str]) -> list[asyncio.Task]:
+    """
+    Start fetching message details concurrently (bounded).
+    Each task resolves to the detail or to the exception that fetch raised.
+    """
+    sem = asyncio.Semaphore(_MAX_DETAIL_FETCHES)
+
+    async def fetch(msg_id: str):
+        async with sem:
+            try:
+                return await get_message_detail(token, msg_id)
+            except Exception as e:
+                return e
+
+    return [asyncio.create_task(fetch(i)) for i in msg_ids]
+
+
 async def callback_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    if await _rate_check(update, context, "refresh"):
+    user_id = update.effective_user.id
+    if await _rate_check(update, context, user_id, "refresh"):
         return
-    user_id = str(update.effective_user.id)
+    await query.answer()
 
     session = db.get_session(user_id)
-    if not session:
+    state, _ = _session_state(session)
+    if state == "none":
         await _send_page(
             update,
             context,
             user_id,
             "no_mail",
             "Сначала нужен активный ящик.\n\n<blockquote>Нажми «📬 Создать почту».</blockquote>",
-            reply_markup=_kb_no_mail(),
+            reply_markup=_KB_NO_MAIL,
         )
         return
 
-    if _is_session_expired(session["created_at"]):
+    if state == "expired":
         await _send_page(
             update,
             context,
             user_id,
             "expired",
             "Эта почта уже завершилась по времени.\n\n<blockquote>Создадим новую?</blockquote>",
-            reply_markup=_kb_expired(),
+            reply_markup=_KB_EXPIRED,
         )
         return
 
     try:
-        messages = get_messages(session["token"])
+        token = session["token"]
+        messages = await get_messages(token)
+        ids = [m["id"] for m in messages if m.get("id")]
+        seen = db.get_seen_ids(ids)
+        claimed = set(db.claim_messages_seen([i for i in ids if i not in seen]))
+        unseen = [m for m in messages if m.get("id") in claimed]
+        # Send mails in inbox order, several per message, each chunk as soon as
+        # its details are in while the later fetches keep running
+        fetches = _start_detail_fetches(token, [m["id"] for m in unseen])
         new_count = 0
-        for msg in messages:
-            msg_id = msg.get("id")
-            if not msg_id or not db.claim_message_seen(msg_id):
-                continue
-            try:
-                detail = get_message_detail(session["token"], msg_id)
-                parsed = parse_message(msg, detail)
-                await _send_message_to_user(context, user_id, parsed)
-                new_count += 1
-            except Exception:
-                db.unmark_message_seen(msg_id)
-                raise
+        try:
+            for i in range(0, len(unseen), MAX_MAILS_PER_MESSAGE):
+                chunk = unseen[i:i + MAX_MAILS_PER_MESSAGE]
+                try:
+                    parsed = []
+                    for msg, fetch in zip(chunk, fetches[i:i + MAX_MAILS_PER_MESSAGE]):
+                        detail = await fetch
+                        if isinstance(detail, Exception):
+                            raise detail
+                        parsed.append(parse_message(msg, detail))
+                    for group in pack_mails(parsed):
+                        if not await send_messages(context.bot, user_id, group):
+                            raise RuntimeError(f"sending {len(group)} mail(s) to {user_id} failed")
+                        new_count += len(group)
+                except Exception:
+                    # Release the unsent claims so the next refresh retries them
+                    db.unmark_messages_seen([m["id"] for m in unseen[new_count:]])
+                    raise
+        finally:
+            for fetch in fetches:
+                fetch.cancel()
 
         if new_count == 0:
             await _send_page(
@@ -311,7 +345,7 @@ async def callback_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 user_id,
                 "no_mail",
                 "Пока новых писем нет.\n\n<blockquote>Можно проверить снова чуть позже.</blockquote>",
-                reply_markup=_kb_active(),
+                reply_markup=_KB_ACTIVE,
             )
         else:
             await query.answer(f"Новых писем: {new_count}")
@@ -323,7 +357,7 @@ async def callback_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id,
             "generic_error",
             "Не получилось проверить входящие.\n\n<blockquote>Попробуй ещё раз через минуту.</blockquote>",
-            reply_markup=_kb_active(),
+            reply_markup=_KB_ACTIVE,
         )
 
 
@@ -333,10 +367,10 @@ async def callback_new_mail(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def callback_delete_mail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    if await _rate_check(update, context, "general"):
+    user_id = update.effective_user.id
+    if await _rate_check(update, context, user_id, "general"):
         return
-    user_id = str(update.effective_user.id)
+    await query.answer()
 
     session = db.get_session(user_id)
     if not session:
@@ -346,7 +380,7 @@ async def callback_delete_mail(update: Update, context: ContextTypes.DEFAULT_TYP
             user_id,
             "no_mail",
             "Сейчас активной почты нет, удалять нечего.",
-            reply_markup=_kb_no_mail(),
+            reply_markup=_KB_NO_MAIL,
         )
         return
 
@@ -357,14 +391,14 @@ async def callback_delete_mail(update: Update, context: ContextTypes.DEFAULT_TYP
         user_id,
         "delete_success",
         "Готово, почта удалена.\n\n<blockquote>Если понадобится, быстро создадим новую.</blockquote>",
-        reply_markup=_kb_no_mail(),
+        reply_markup=_KB_NO_MAIL,
     )
 
 
 async def callback_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = str(update.effective_user.id)
+    user_id = update.effective_user.id
     await _send_page(
         update,
         context,
@@ -375,35 +409,20 @@ async def callback_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def _send_message_to_user(context: ContextTypes.DEFAULT_TYPE, user_id: str, parsed: dict):
-    lines = [
-        f"📧 *От:* {parsed['from_addr']}",
-        f"*Тема:* {parsed['subject']}",
-        "",
-    ]
-    if parsed.get("intro"):
-        lines.append(parsed["intro"][:400])
-        if len(parsed.get("intro", "")) > 400:
-            lines.append("...")
-
-    if parsed.get("codes"):
-        lines.append("")
-        lines.append("*Коды:* " + ", ".join(f"`{c}`" for c in parsed["codes"]))
-
-    text = "\n".join(lines)
+CALLBACK_HANDLERS = {
+    CB_CREATE_MAIL: callback_create_mail,
+    CB_MY_MAIL: callback_my_mail,
+    CB_REFRESH: callback_refresh,
+    CB_NEW_MAIL: callback_new_mail,
+    CB_DELETE_MAIL: callback_delete_mail,
+    CB_HOME: callback_home,
+}
 
-    buttons = []
-    url_labels = parsed.get("url_labels") or {}
-    for url in parsed.get("urls", [])[:5]:
-        label = get_button_label(url, url_labels.get(url))
-        buttons.append([InlineKeyboardButton(label, url=url)])
 
-    reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
-    await send_message_with_gif(
-        context.bot,
-        user_id,
-        "new_mail",
-        text,
-        reply_markup=reply_markup,
-        parse_mode="Markdown",
-    )
+async def callback_dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route callback queries by exact callback_data (one dict lookup, no regex)."""
+    handler = CALLBACK_HANDLERS.get(update.callback_query.data)
+    if handler is None:
+        await update.callback_query.answer()
+        return
+    await handler(update, context)
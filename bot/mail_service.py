@@ -1,54 +1,142 @@
-"""Mail.tm API client with retry logic."""
+"""Mail.tm API client with retry logic (one persistent async HTTP client)."""
+import asyncio
 import random
 import string
 import time
 import logging
+from collections.abc import AsyncIterator
 from typing import Any
 
-import requests
+import httpx
+import orjson
 
-from config import MAIL_TM_BASE, RETRY_ATTEMPTS, RETRY_BACKOFF
+from config import MAIL_TM_BASE, MAIL_TM_MERCURE, RETRY_ATTEMPTS, RETRY_BACKOFF
 
 logger = logging.getLogger(__name__)
 
+# Shared per process: keep-alive + HTTP/2 so repeat calls skip the TLS handshake
+_client: httpx.AsyncClient | None = None
+# Mercure streams stay open for hours; a client of their own keeps them out of the API pool
+_stream_client: httpx.AsyncClient | None = None
+
+# Fail fast on connect, allow slow responses; pool sized for a full poll cycle
+_TIMEOUT = httpx.Timeout(15, connect=5)
+_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+_MAX_RETRY_AFTER = 30  # cap on a server-requested wait, seconds
+# A quiet mailbox sends nothing; reconnect after this long rather than trust a dead socket
+_STREAM_TIMEOUT = httpx.Timeout(15, connect=5, read=120)
+
+# Domain list changes rarely; cache it so account creation is one request shorter
+_DOMAINS_TTL = 600
+_domains_cache: tuple[float, list[str]] | None = None  # (monotonic fetch time, domains)
+_domains_lock = asyncio.Lock()
+
+# token -> (ETag, messages) of its last listing: a 304 reuses the messages unparsed
+_MAX_LISTINGS = 1024
+_listings: dict[str, tuple[str, list[dict]]] = {}
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(http2=True, timeout=_TIMEOUT, limits=_LIMITS)
+    return _client
+
+
+def _get_stream_client() -> httpx.AsyncClient:
+    global _stream_client
+    if _stream_client is None:
+        _stream_client = httpx.AsyncClient(
+            http2=True,
+            timeout=_STREAM_TIMEOUT,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=8),
+        )
+    return _stream_client
+
+
+async def close_client():
+    """Close the shared HTTP clients (call on bot shutdown)."""
+    global _client, _stream_client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    if _stream_client is not None:
+        await _stream_client.aclose()
+        _stream_client = None
+
 
 def _random_string(length: int = 12) -> str:
     return "".join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
 
-def _retry_request(method: str, url: str, **kwargs) -> requests.Response:
-    """Execute request with exponential backoff on 5xx/timeout."""
+def _retry_delay(attempt: int, resp: httpx.Response | None) -> float:
+    """Server's Retry-After on 429/503 if given, else backoff with up to 50% jitter."""
+    if resp is not None and resp.status_code in (429, 503):
+        retry_after = resp.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), _MAX_RETRY_AFTER)
+    base = RETRY_BACKOFF[min(attempt, len(RETRY_BACKOFF) - 1)]
+    # Jitter keeps concurrent pollers from retrying in lockstep
+    return base * (1 + random.random() * 0.5)
+
+
+def _json(resp: httpx.Response) -> Any:
+    """Decode a response body with orjson (detail bodies carry large HTML)."""
+    return orjson.loads(resp.content)
+
+
+async def _retry_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Execute request with jittered exponential backoff on 429/5xx/timeout."""
     last_exc = None
     for attempt in range(RETRY_ATTEMPTS):
+        resp = None
         try:
-            resp = requests.request(method, url, timeout=15, **kwargs)
-            if 500 <= resp.status_code < 600:
-                raise requests.RequestException(f"Server error: {resp.status_code}")
+            resp = await _get_client().request(method, url, **kwargs)
+            if resp.status_code == 429 or 500 <= resp.status_code < 600:
+                resp.raise_for_status()
             return resp
-        except (requests.Timeout, requests.RequestException) as e:
+        except httpx.HTTPError as e:
             last_exc = e
             if attempt < RETRY_ATTEMPTS - 1:
-                delay = RETRY_BACKOFF[min(attempt, len(RETRY_BACKOFF) - 1)]
-                logger.warning("Mail.tm request failed (attempt %d), retry in %ds: %s", attempt + 1, delay, e)
-                time.sleep(delay)
+                delay = _retry_delay(attempt, resp)
+                logger.warning("Mail.tm request failed (attempt %d), retry in %.1fs: %s", attempt + 1, delay, e)
+                await asyncio.sleep(delay)
     raise last_exc
 
 
-def get_domains() -> list[str]:
-    """Fetch available Mail.tm domains."""
-    resp = _retry_request("GET", f"{MAIL_TM_BASE}/domains")
-    resp.raise_for_status()
-    data = resp.json()
-    members = data.get("hydra:member", [])
-    return [d["domain"] for d in members if d.get("isActive", True)]
-
-
-def create_account() -> tuple[str, str, str]:
+def _cached_domains() -> list[str] | None:
+    if _domains_cache and time.monotonic() - _domains_cache[0] < _DOMAINS_TTL:
+        return _domains_cache[1]
+    return None
+
+
+async def get_domains() -> list[str]:
+    """Fetch available Mail.tm domains (cached for _DOMAINS_TTL seconds)."""
+    global _domains_cache
+    domains = _cached_domains()
+    if domains is not None:
+        return domains
+    # One refetch at a time; callers that queued behind it reuse its result
+    async with _domains_lock:
+        domains = _cached_domains()
+        if domains is not None:
+            return domains
+        resp = await _retry_request("GET", f"{MAIL_TM_BASE}/domains")
+        resp.raise_for_status()
+        data = _json(resp)
+        members = data.get("hydra:member", [])
+        domains = [d["domain"] for d in members if d.get("isActive", True)]
+        if domains:
+            _domains_cache = (time.monotonic(), domains)
+        return domains
+
+
+async def create_account() -> tuple[str, str, str]:
     """
     Create a new Mail.tm account.
     Returns (email, token, account_id).
     """
-    domains = get_domains()
+    domains = await get_domains()
     if not domains:
         raise ValueError("No domains available")
     domain = random.choice(domains)
@@ -56,7 +144,7 @@ def create_account() -> tuple[str, str, str]:
     email = f"{local}@{domain}"
     password = _random_string(16)
 
-    resp = _retry_request(
+    resp = await _retry_request(
         "POST",
         f"{MAIL_TM_BASE}/accounts",
         json={"address": email, "password": password},
@@ -64,39 +152,48 @@ def create_account() -> tuple[str, str, str]:
     )
     if resp.status_code == 422:
         # Address might be taken, try again with different local
-        return create_account()
+        return await create_account()
     resp.raise_for_status()
-    account = resp.json()
+    account = _json(resp)
     account_id = account["id"]
 
-    resp = _retry_request(
+    resp = await _retry_request(
         "POST",
         f"{MAIL_TM_BASE}/token",
         json={"address": email, "password": password},
         headers={"Content-Type": "application/json"},
     )
     resp.raise_for_status()
-    token_data = resp.json()
+    token_data = _json(resp)
     token = token_data["token"]
 
     return email, token, account_id
 
 
-def get_messages(token: str) -> list[dict]:
-    """Fetch message list for account."""
-    resp = _retry_request(
-        "GET",
-        f"{MAIL_TM_BASE}/messages",
-        headers={"Authorization": f"Bearer {token}"},
-    )
+async def get_messages(token: str) -> list[dict]:
+    """Fetch message list for account (conditional on the last ETag, if any)."""
+    headers = {"Authorization": f"Bearer {token}"}
+    cached = _listings.get(token)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    resp = await _retry_request("GET", f"{MAIL_TM_BASE}/messages", headers=headers)
+    if resp.status_code == 304 and cached:
+        # Same list as last time (not []: unseen ids in it may be due for a retry)
+        return cached[1]
     resp.raise_for_status()
-    data = resp.json()
-    return data.get("hydra:member", [])
+    messages = _json(resp).get("hydra:member", [])
+    _listings.pop(token, None)
+    etag = resp.headers.get("ETag")
+    if etag:
+        _listings[token] = (etag, messages)
+        if len(_listings) > _MAX_LISTINGS:
+            del _listings[next(iter(_listings))]
+    return messages
 
 
-def get_message_detail(token: str, message_id: str) -> dict | None:
+async def get_message_detail(token: str, message_id: str) -> dict | None:
     """Fetch full message with text, html, verifications."""
-    resp = _retry_request(
+    resp = await _retry_request(
         "GET",
         f"{MAIL_TM_BASE}/messages/{message_id}",
         headers={"Authorization": f"Bearer {token}"},
@@ -104,4 +201,38 @@ def get_message_detail(token: str, message_id: str) -> dict | None:
     if resp.status_code == 404:
         return None
     resp.raise_for_status()
-    return resp.json()
+    return _json(resp)
+
+
+async def stream_account_events(
+    token: str, account_id: str, last_event_id: str | None = None,
+) -> AsyncIterator[tuple[str | None, dict]]:
+    """
+    Follow the account's Mercure topic, yielding (event id, update) for each
+    update (new or changed message, account usage) until the server closes
+    the stream. Pass the last id seen to have the hub replay what was missed.
+    """
+    headers = {"Authorization": f"Bearer {token}", "Accept": "text/event-stream"}
+    if last_event_id:
+        headers["Last-Event-ID"] = last_event_id
+    async with _get_stream_client().stream(
+        "GET",
+        MAIL_TM_MERCURE,
+        params={"topic": f"/accounts/{account_id}"},
+        headers=headers,
+    ) as resp:
+        resp.raise_for_status()
+        data: list[str] = []
+        event_id = None
+        async for line in resp.aiter_lines():
+            if line.startswith("data:"):
+                data.append(line[6:] if line.startswith("data: ") else line[5:])
+            elif line.startswith("id:"):
+                event_id = line[4:] if line.startswith("id: ") else line[3:]
+            elif not line and data:
+                # Blank line ends an event; comments and retry fields are ignored
+                try:
+                    yield event_id, orjson.loads("\n".join(data))
+                except orjson.JSONDecodeError:
+                    logger.warning("Skipping malformed Mercure event for %s", account_id)
+                data = []
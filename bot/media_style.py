@@ -1,18 +1,33 @@
 """GIF style helpers (Telegram file_id / URL based)."""
+import asyncio
 import logging
+import re
+from datetime import timedelta
+from html import unescape
 
-import requests
+from telegram.error import BadRequest, RetryAfter
 
+import db
 from config import GIF_DEFAULT_FILE_ID, GIF_DEFAULT_URL, GIF_FILE_IDS, GIF_URLS
 
 logger = logging.getLogger(__name__)
 
-TELEGRAM_ANIMATION_API = "https://api.telegram.org/bot{token}/sendAnimation"
-TELEGRAM_MESSAGE_API = "https://api.telegram.org/bot{token}/sendMessage"
+CAPTION_LIMIT = 1024  # Telegram caption length limit for animations, after entity parsing
+_HTML_TAG = re.compile(r"<[^>]+>")
 
+# BadRequest texts meaning the animation reference itself is unusable
+_BAD_FILE_ERRORS = ("file identifier", "http url content", "web page content")
 
-def pick_gif(tag: str) -> str:
-    """Pick animation reference for a tag, fallback to file_id or URL."""
+# GIF URL -> file_id Telegram assigned on first send (reused to skip re-download)
+_learned_file_ids: dict[str, str] = {}
+
+
+def load_gif_cache():
+    """Load learned file_ids persisted by previous runs."""
+    _learned_file_ids.update(db.get_gif_file_ids())
+
+
+def _pick_gif_uncached(tag: str) -> str:
     return (
         GIF_FILE_IDS.get(tag)
         or GIF_DEFAULT_FILE_ID
@@ -21,40 +36,76 @@ def pick_gif(tag: str) -> str:
     )
 
 
-async def send_gif(bot, chat_id: str | int, tag: str) -> bool:
-    """
-    Send GIF via PTB bot using Telegram file_id or URL.
-    Returns False silently if nothing configured.
-    """
-    file_id = pick_gif(tag)
-    if not file_id:
-        return False
+# Config is fixed at import, so every tag's reference is resolved once here
+_GIF_FOR_TAG = {tag: _pick_gif_uncached(tag) for tag in GIF_FILE_IDS.keys() | GIF_URLS.keys()}
+_GIF_FALLBACK = _pick_gif_uncached("")
+
+
+def rendered_length(text: str, parse_mode: str | None) -> int:
+    """Length Telegram checks against its text limits: rendered text, in UTF-16 units."""
+    if parse_mode == "HTML":
+        text = unescape(_HTML_TAG.sub("", text))
+    return len(text.encode("utf-16-le")) // 2
+
+
+def pick_gif(tag: str) -> str:
+    """Pick animation reference for a tag, fallback to file_id or URL."""
+    return _GIF_FOR_TAG.get(tag, _GIF_FALLBACK)
+
+
+def _resolve(ref: str) -> str:
+    return _learned_file_ids.get(ref, ref)
+
+
+def _learn_file_id(ref: str, msg) -> None:
+    """Remember the file_id of a URL-sent GIF so later sends reuse it."""
+    if ref in _learned_file_ids or not ref.startswith("http"):
+        return
+    animation = getattr(msg, "animation", None)
+    if animation and animation.file_id:
+        _learned_file_ids[ref] = animation.file_id
+        db.save_gif_file_id(ref, animation.file_id)
+
+
+def _forget_file_id(ref: str, error: Exception) -> None:
+    """Drop a learned file_id only if Telegram rejected the file (e.g. bot token changed)."""
+    if not isinstance(error, BadRequest):
+        return  # blocked chat, timeout, flood control: the file_id is still good
+    message = error.message.lower()
+    if not any(part in message for part in _BAD_FILE_ERRORS):
+        return
+    if _learned_file_ids.pop(ref, None) is not None:
+        db.delete_gif_file_id(ref)
+
+
+async def _call(send, **kwargs):
+    """Run one Bot API send; on flood control wait as long as Telegram asks, retry once."""
     try:
-        await bot.send_animation(chat_id=chat_id, animation=file_id)
-        return True
-    except Exception as e:
-        logger.warning("send_gif failed (tag=%s): %s", tag, e)
-        return False
+        return await send(**kwargs)
+    except RetryAfter as e:
+        delay = e.retry_after
+        if isinstance(delay, timedelta):
+            delay = delay.total_seconds()
+        logger.warning("Telegram flood control, retry in %ss", delay)
+        await asyncio.sleep(delay)
+        return await send(**kwargs)
 
 
-def send_gif_sync(token: str, chat_id: str | int, tag: str) -> bool:
+async def send_gif(bot, chat_id: str | int, tag: str) -> bool:
     """
-    Send GIF via plain Telegram HTTP API (for sender thread).
+    Send GIF via PTB bot using Telegram file_id or URL.
     Returns False silently if nothing configured.
     """
-    file_id = pick_gif(tag)
-    if not file_id:
+    ref = pick_gif(tag)
+    if not ref:
         return False
     try:
-        resp = requests.post(
-            TELEGRAM_ANIMATION_API.format(token=token),
-            json={"chat_id": chat_id, "animation": file_id},
-            timeout=10,
-        )
-        resp.raise_for_status()
+        msg = await _call(bot.send_animation, chat_id=chat_id, animation=_resolve(ref))
+        _learn_file_id(ref, msg)
         return True
     except Exception as e:
-        logger.warning("send_gif_sync failed (tag=%s): %s", tag, e)
+        _forget_file_id(ref, e)
+        logger.warning("send_gif failed (tag=%s): %s", tag, e)
         return False
 
 
@@ -68,23 +119,28 @@ async def send_message_with_gif(
 ) -> object | None:
     """
     Send one combined message: GIF + caption.
-    Falls back to plain text message if GIF can't be sent.
+    Falls back to plain text message if GIF can't be sent
+    or the text is too long for a caption.
     """
-    file_id = pick_gif(tag)
-    if file_id:
+    ref = pick_gif(tag)
+    if ref and rendered_length(text, parse_mode) <= CAPTION_LIMIT:
         try:
-            msg = await bot.send_animation(
+            msg = await _call(
+                bot.send_animation,
                 chat_id=chat_id,
-                animation=file_id,
+                animation=_resolve(ref),
                 caption=text,
                 parse_mode=parse_mode,
                 reply_markup=reply_markup,
             )
+            _learn_file_id(ref, msg)
             return msg
         except Exception as e:
+            _forget_file_id(ref, e)
             logger.warning("send_message_with_gif animation failed (tag=%s): %s", tag, e)
     try:
-        msg = await bot.send_message(
+        msg = await _call(
+            bot.send_message,
             chat_id=chat_id,
             text=text,
             parse_mode=parse_mode,
@@ -94,51 +150,3 @@ async def send_message_with_gif(
     except Exception as e:
         logger.warning("send_message_with_gif fallback text failed (tag=%s): %s", tag, e)
         return None
-
-
-def send_message_with_gif_sync(
-    token: str,
-    chat_id: str | int,
-    tag: str,
-    text: str,
-    reply_markup: dict | None = None,
-    parse_mode: str = "HTML",
-) -> bool:
-    """
-    Send one combined message over raw Telegram API: GIF + caption.
-    Falls back to plain text sendMessage.
-    """
-    file_id = pick_gif(tag)
-    if file_id:
-        try:
-            payload = {
-                "chat_id": chat_id,
-                "animation": file_id,
-                "caption": text,
-                "parse_mode": parse_mode,
-            }
-            if reply_markup:
-                payload["reply_markup"] = reply_markup
-            resp = requests.post(
-                TELEGRAM_ANIMATION_API.format(token=token),
-                json=payload,
-                timeout=10,
-            )
-            resp.raise_for_status()
-            return True
-        except Exception as e:
-            logger.warning("send_message_with_gif_sync animation failed (tag=%s): %s", tag, e)
-    try:
-        payload = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
-        resp = requests.post(
-            TELEGRAM_MESSAGE_API.format(token=token),
-            json=payload,
-            timeout=10,
-        )
-        resp.raise_for_status()
-        return True
-    except Exception as e:
-        logger.warning("send_message_with_gif_sync fallback text failed (tag=%s): %s", tag, e)
-        return False
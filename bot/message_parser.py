@@ -1,26 +1,29 @@
 """Extract links, codes, and verifications from email content."""
 import re
+from html import unescape
 from typing import Any
 
 from config import MAX_LINKS_PER_MESSAGE
 
-# URL regex - matches http/https links
-URL_PATTERN = re.compile(r"https?://[^\s<>\"')\]]+", re.IGNORECASE)
+# One scan for both link forms: HTML href attribute values, or bare http/https
+# links. Both start with "h", factored out so the scanner tests one char per
+# position; findall yields (h, href_url, rest_of_bare_url).
+LINK_PATTERN = re.compile(
+    r'(h)(?:ref=["\']?(https?://[^"\'>\s]+)["\']?|(ttps?://[^\s<>"\')\]]+))',
+    re.IGNORECASE,
+)
 
-# HTML href attribute
-HREF_PATTERN = re.compile(r'href=["\']?(https?://[^"\'>\s]+)["\']?', re.IGNORECASE)
+# Rest of an <a> tag after its href value: remaining attributes, then short link text.
+# Matched right where a LINK_PATTERN href ends, so labels need no scan of their own.
+LINK_TEXT_TAIL = re.compile(r'[^>]*>([^<]{1,40})</a>', re.IGNORECASE)
 
-# <a href="url">link text</a> - extract url and button text
-HREF_WITH_TEXT = re.compile(
-    r'<a[^>]*href=["\']?(https?://[^"\'>\s]+)["\']?[^>]*>([^<]{1,40})</a>',
-    re.IGNORECASE | re.DOTALL,
-)
+# Tags (with script/style bodies) to drop when HTML is the only body to search for codes
+TAG_PATTERN = re.compile(r"<(script|style)\b.*?</\1\s*>|<[^>]+>", re.IGNORECASE | re.DOTALL)
 
 # Verification codes: digits or explicit code/verify/otp patterns (avoid matching common words)
+# Keyword patterns stay separate: each has a literal prefix re can search for fast.
 CODE_PATTERNS = [
-    re.compile(r"\b(\d{6})\b"),  # 6 digits
-    re.compile(r"\b(\d{4})\b"),  # 4 digits
-    re.compile(r"\b(\d{8})\b"),  # 8 digits
+    re.compile(r"\b(\d{4}(?:\d{2}){0,2})\b"),  # 4, 6 or 8 digits, one scan
     re.compile(r"code[:\s]+([A-Za-z0-9]{4,12})", re.IGNORECASE),
     re.compile(r"verification[:\s]+([A-Za-z0-9]{4,12})", re.IGNORECASE),
     re.compile(r"otp[:\s]+([A-Za-z0-9]{4,12})", re.IGNORECASE),
@@ -28,6 +31,11 @@ CODE_PATTERNS = [
     re.compile(r"([A-Za-z0-9]{6,12})\s*(?:is your|код|code)", re.IGNORECASE),
 ]
 
+# Image extensions and tracking/static URL fragments, checked against the lowercased URL
+_IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg", ".ico")
+_JUNK_FRAGMENTS = ("/pixel", "tracking", "analytics", "pixel.", "unsubscribe", "open?",
+                   "cdn.", "static.", "img.", "images.", "assets.", "logo.", "icon.")
+
 # Common words to exclude from "codes" (false positives)
 CODE_STOPLIST = frozenset({
     "team", "logo", "started", "paste", "below", "message", "reserved", "medium",
@@ -45,11 +53,16 @@ CODE_STOPLIST = frozenset({
 def _is_image_or_tracking(url: str) -> bool:
     """Exclude image URLs and tracking pixels."""
     u = url.lower()
-    if any(u.endswith(ext) or ext in u.split("?")[0] for ext in (".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg", ".ico")):
-        return True
-    if any(x in u for x in ("/pixel", "tracking", "analytics", "pixel.", "unsubscribe", "open?",
-                            "cdn.", "static.", "img.", "images.", "assets.", "logo.", "icon.")):
+    if u.endswith(_IMAGE_EXTS):
         return True
+    # Plain substring loops beat one big alternation regex: each `in` is a fast C scan
+    path = u.partition("?")[0]
+    for ext in _IMAGE_EXTS:
+        if ext in path:
+            return True
+    for fragment in _JUNK_FRAGMENTS:
+        if fragment in u:
+            return True
     return False
 
 
@@ -66,7 +79,8 @@ def _activation_priority(url: str) -> int:
 def get_button_label(url: str, link_text: str | None = None) -> str:
     """Return human-readable label for URL button. Uses link_text from HTML if valid."""
     if link_text:
-        clean = re.sub(r"\s+", " ", link_text).strip()
+        # Same as collapsing \s+ runs and stripping, without the regex engine
+        clean = " ".join(link_text.split())
         if clean and len(clean) <= 35 and not clean.startswith("http"):
             return clean
     u = url.lower()
@@ -85,34 +99,31 @@ def get_button_label(url: str, link_text: str | None = None) -> str:
     return "Открыть ссылку"
 
 
-def _extract_url_labels(html: list[str] | None) -> dict[str, str]:
-    """Extract url -> link text from HTML <a> tags."""
-    labels = {}
-    if not html:
-        return labels
-    for block in html:
-        if not isinstance(block, str):
+def _scan_links(block: str, urls: set[str], labels: dict[str, str] | None = None):
+    """One pass over a block: collect raw URLs and, if labels is given, <a> link texts."""
+    for m in LINK_PATTERN.finditer(block):
+        href = m.group(2)
+        if not href:
+            urls.add("h" + m.group(3))
+            continue
+        urls.add(href)
+        if labels is None:
             continue
-        for m in HREF_WITH_TEXT.finditer(block):
-            url = m.group(1).rstrip(".,;:!)")
-            text = re.sub(r"<[^>]+>", "", m.group(2)).strip()
-            if url and text and url not in labels:
-                labels[url] = text[:35]
-    return labels
+        # Only an href inside an <a ...> tag followed by short text carries a label
+        tag_start = block.rfind("<", 0, m.start())
+        if tag_start < 0 or block[tag_start + 1:tag_start + 2] not in "aA" or ">" in block[tag_start:m.start()]:
+            continue
+        tail = LINK_TEXT_TAIL.match(block, m.end())
+        if tail is None:
+            continue
+        url = href.rstrip(".,;:!)")
+        text = tail.group(1).strip()
+        if url and text and url not in labels:
+            labels[url] = text[:35]
 
 
-def extract_urls(text: str | None, html: list[str] | None) -> list[str]:
-    """Extract unique URLs from text and HTML. Excludes images/tracking, prioritizes activation links."""
-    urls = set()
-    if text:
-        urls.update(URL_PATTERN.findall(text))
-        urls.update(HREF_PATTERN.findall(text))
-    if html:
-        for block in html:
-            if isinstance(block, str):
-                urls.update(URL_PATTERN.findall(block))
-                urls.update(HREF_PATTERN.findall(block))
-    # Deduplicate, filter junk, prioritize activation links
+def _rank_urls(urls: set[str]) -> list[str]:
+    """Deduplicate, filter junk, prioritize activation links."""
     seen = set()
     candidates = []
     for u in urls:
@@ -124,14 +135,29 @@ def extract_urls(text: str | None, html: list[str] | None) -> list[str]:
     return candidates[:MAX_LINKS_PER_MESSAGE]
 
 
+def extract_urls(text: str | None, html: list[str] | None) -> list[str]:
+    """Extract unique URLs from text and HTML. Excludes images/tracking, prioritizes activation links."""
+    urls = set()
+    if text:
+        _scan_links(text, urls)
+    for block in html or ():
+        if isinstance(block, str):
+            _scan_links(block, urls)
+    return _rank_urls(urls)
+
+
+def _html_to_text(html: list[str]) -> str:
+    # Decode entities too, or references like &#8204; (preheader padding) read as codes
+    return unescape(" ".join(TAG_PATTERN.sub(" ", block) for block in html if isinstance(block, str)))
+
+
 def extract_codes(text: str | None) -> list[str]:
     """Extract verification/code-like strings from text. Excludes common words."""
     if not text:
         return []
     codes = set()
     for pat in CODE_PATTERNS:
-        for m in pat.finditer(text):
-            code = m.group(1)
+        for code in pat.findall(text):
             if code and 4 <= len(code) <= 12 and code.lower() not in CODE_STOPLIST:
                 # Prefer codes with digits or mixed case (less likely to be words)
                 has_digit = any(c.isdigit() for c in code)
@@ -144,6 +170,7 @@ def parse_message(message: dict, detail: dict | None = None) -> dict[str, Any]:
     """
     Parse message and detail into structured data for Telegram.
     Returns: {
+        "id": str,
         "subject": str,
         "from_addr": str,
         "intro": str,
@@ -168,9 +195,17 @@ def parse_message(message: dict, detail: dict | None = None) -> dict[str, Any]:
         if isinstance(verifications, str):
             verifications = [verifications] if verifications else []
 
-    urls = extract_urls(text or intro, html if html else [intro])
-    codes = extract_codes(text or intro)
-    url_labels = _extract_url_labels(html if html else [intro] if intro else None)
+    # Each HTML block is scanned once for both links and their button labels
+    raw_urls: set[str] = set()
+    url_labels: dict[str, str] = {}
+    if text or intro:
+        _scan_links(text or intro, raw_urls)
+    for block in html or [intro]:
+        if isinstance(block, str):
+            _scan_links(block, raw_urls, url_labels)
+    urls = _rank_urls(raw_urls)
+    # HTML-only mails: search the tag-stripped body rather than the short intro
+    codes = extract_codes(text or (html and _html_to_text(html)) or intro)
 
     # Add verification URLs
     for v in verifications:
@@ -179,6 +214,7 @@ def parse_message(message: dict, detail: dict | None = None) -> dict[str, Any]:
     urls = urls[:MAX_LINKS_PER_MESSAGE]
 
     return {
+        "id": message.get("id", ""),
         "subject": subject,
         "from_addr": from_addr,
         "intro": intro[:500] if intro else "",
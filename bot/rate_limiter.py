@@ -1,46 +1,61 @@
-"""In-memory per-user rate limiter with TTL auto-cleanup."""
-import threading
+"""In-memory per-user token-bucket rate limiter with TTL auto-cleanup.
+
+Only called from handlers on the bot's event loop, so it needs no locking.
+"""
 import time
-from collections import defaultdict
 
 from config import RATE_LIMIT_CREATE, RATE_LIMIT_REFRESH, RATE_LIMIT_GENERAL
 
-_lock = threading.Lock()
-_buckets: dict[str, list[float]] = defaultdict(list)
+# (user_id, action) -> (tokens left, monotonic time of last check)
+_buckets: dict[tuple[int, str], tuple[float, float]] = {}
 
 _LAST_CLEANUP = 0.0
 _CLEANUP_INTERVAL = 300  # purge stale entries every 5 min
 
+# action -> (bucket capacity, window in seconds to refill it completely)
 LIMITS = {
     "create_mail": (RATE_LIMIT_CREATE, 3600),
     "refresh":     (RATE_LIMIT_REFRESH, 60),
     "general":     (RATE_LIMIT_GENERAL, 60),
 }
 
+# action -> (capacity, tokens refilled per second, window)
+_BUCKETS_SPEC = {
+    action: (capacity, capacity / window, window)
+    for action, (capacity, window) in LIMITS.items()
+}
+
 
-def _cleanup_if_needed():
+def _cleanup_if_needed(now: float):
     global _LAST_CLEANUP
-    now = time.monotonic()
     if now - _LAST_CLEANUP < _CLEANUP_INTERVAL:
         return
     _LAST_CLEANUP = now
-    stale_keys = [k for k, v in _buckets.items() if not v]
+    # A bucket idle for a whole window is full again, same as having no entry
+    stale_keys = [
+        k for k, (_, last) in _buckets.items()
+        if now - last >= _BUCKETS_SPEC.get(k[1], _BUCKETS_SPEC["general"])[2]
+    ]
     for k in stale_keys:
         _buckets.pop(k, None)
 
 
-def is_allowed(user_id: str, action: str) -> bool:
+def is_allowed(user_id: int, action: str) -> bool:
     """Return True if the action is within rate limits, False if throttled."""
-    max_count, window = LIMITS.get(action, LIMITS["general"])
-    key = f"{user_id}:{action}"
+    capacity, rate, _ = _BUCKETS_SPEC.get(action) or _BUCKETS_SPEC["general"]
+    key = (user_id, action)
     now = time.monotonic()
-    cutoff = now - window
-
-    with _lock:
-        _cleanup_if_needed()
-        timestamps = _buckets[key]
-        _buckets[key] = [t for t in timestamps if t > cutoff]
-        if len(_buckets[key]) >= max_count:
-            return False
-        _buckets[key].append(now)
-        return True
+    _cleanup_if_needed(now)
+
+    state = _buckets.get(key)
+    if state is None:
+        tokens = capacity
+    else:
+        tokens, last = state
+        tokens = min(capacity, tokens + (now - last) * rate)
+
+    if tokens < 1:
+        _buckets[key] = (tokens, now)
+        return False
+    _buckets[key] = (tokens - 1, now)
+    return True
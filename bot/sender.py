@@ -1,75 +1,173 @@
-"""Send Telegram messages via HTTP API (for background thread)."""
+"""Send Telegram messages from the mail pipeline (asyncio task on the bot loop)."""
+import asyncio
 import logging
-import queue
-import threading
 import time
+from html import escape
 
-from bot.media_style import send_message_with_gif_sync
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import db
+from bot.media_style import rendered_length, send_message_with_gif
 from bot.message_parser import get_button_label
 
 logger = logging.getLogger(__name__)
 
+_MAX_BATCH = 10              # queue items drained per sender iteration
+_MAX_PARALLEL_CHATS = 8      # chats sent to concurrently within a batch
+MAX_MAILS_PER_MESSAGE = 5    # mails combined into one message at most, length permitting
+_MAIL_SEPARATOR = "\n\n➖➖➖\n\n"
+_TEXT_LIMIT = 4096           # Telegram message text limit, after entity parsing
+# Sender and subject are cut to this, so even one mail of astral characters stays
+# well under _TEXT_LIMIT (with the 400-char intro and at most 10 codes)
+_FIELD_LIMIT = 256
+
+# Telegram allows about one message per second per chat and ~30/s overall; stay under both
+_CHAT_SEND_INTERVAL = 1.05
+_GLOBAL_SEND_INTERVAL = 1 / 30
+_MAX_TRACKED_CHATS = 1024
+_next_send_at: dict[int, float] = {}  # chat_id -> monotonic time of its next free slot
+_next_global_at = 0.0
+
+
+def _clip(value: str) -> str:
+    return value if len(value) <= _FIELD_LIMIT else value[:_FIELD_LIMIT] + "…"
+
 
 def _format_message(parsed: dict) -> str:
-    lines = [
-        f"📧 *От:* {parsed.get('from_addr', '')}",
-        f"*Тема:* {parsed.get('subject', '(без темы)')}",
-        "",
+    """Render one mail as Telegram HTML; mail fields are escaped, never parsed."""
+    text = (
+        f"📧 <b>От:</b> {escape(_clip(parsed.get('from_addr', '')))}\n"
+        f"<b>Тема:</b> {escape(_clip(parsed.get('subject', '(без темы)')))}\n"
+    )
+    intro = parsed.get("intro")
+    if intro:
+        text += "\n" + (escape(intro) if len(intro) <= 400 else escape(intro[:400]) + "\n...")
+    codes = parsed.get("codes")
+    if codes:
+        text += "\n\n<b>Коды:</b> " + ", ".join(f"<code>{escape(c)}</code>" for c in codes)
+    return text
+
+
+def _build_buttons(urls: list[str], url_labels: dict | None = None) -> list[list[InlineKeyboardButton]]:
+    """Build inline keyboard rows for URLs with smart labels (Activate, Verify, etc.)."""
+    url_labels = url_labels or {}
+    return [
+        [InlineKeyboardButton(get_button_label(url, url_labels.get(url)), url=url)]
+        for url in urls[:5]
     ]
-    if parsed.get("intro"):
-        intro = parsed["intro"][:400]
-        lines.append(intro)
-        if len(parsed.get("intro", "")) > 400:
-            lines.append("...")
 
-    if parsed.get("codes"):
-        lines.append("")
-        lines.append("*Коды:* " + ", ".join(f"`{c}`" for c in parsed["codes"]))
 
-    return "\n".join(lines)
+def pack_mails(parsed_list: list[dict]) -> list[list[dict]]:
+    """
+    Split mails, in order, into groups that each fit one message: at most
+    MAX_MAILS_PER_MESSAGE, combined rendered text within _TEXT_LIMIT.
+    """
+    separator = rendered_length(_MAIL_SEPARATOR, "HTML")
+    groups: list[list[dict]] = []
+    length = 0
+    for parsed in parsed_list:
+        mail = rendered_length(_format_message(parsed), "HTML")
+        if groups and len(groups[-1]) < MAX_MAILS_PER_MESSAGE and length + separator + mail <= _TEXT_LIMIT:
+            groups[-1].append(parsed)
+            length += separator + mail
+        else:
+            groups.append([parsed])
+            length = mail
+    return groups
 
 
-def _build_reply_markup(urls: list[str], url_labels: dict | None = None) -> dict | None:
-    """Build inline keyboard for URLs with smart labels (Activate, Verify, etc.)."""
-    if not urls:
-        return None
-    buttons = []
-    for url in urls[:5]:
-        label = get_button_label(url, (url_labels or {}).get(url))
-        buttons.append([{"text": label, "url": url}])
-    return {"inline_keyboard": buttons}
+async def _wait_send_slot(chat_id: int):
+    """Space mail deliveries per chat and overall so they never trip Telegram's 429."""
+    global _next_global_at
+    now = time.monotonic()
+    if len(_next_send_at) > _MAX_TRACKED_CHATS:
+        for stale in [c for c, at in _next_send_at.items() if at <= now]:
+            del _next_send_at[stale]
+    # Reserve the slot before sleeping so concurrent senders queue up behind it
+    at = max(now, _next_send_at.get(chat_id, 0.0))
+    _next_send_at[chat_id] = at + _CHAT_SEND_INTERVAL
+    if at > now:
+        await asyncio.sleep(at - now)
+    # Global slot only once this chat is due, so a slow chat doesn't hold up others
+    now = time.monotonic()
+    at = max(now, _next_global_at)
+    _next_global_at = at + _GLOBAL_SEND_INTERVAL
+    if at > now:
+        _next_send_at[chat_id] = max(_next_send_at[chat_id], at + _CHAT_SEND_INTERVAL)
+        await asyncio.sleep(at - now)
 
 
-def send_message_sync(token: str, chat_id: str, parsed: dict) -> bool:
-    """Send formatted message to Telegram (sync, for background thread)."""
-    text = _format_message(parsed)
-    reply_markup = _build_reply_markup(parsed.get("urls", []), parsed.get("url_labels"))
-    ok = send_message_with_gif_sync(
-        token=token,
-        chat_id=chat_id,
-        tag="new_mail",
-        text=text,
-        reply_markup=reply_markup,
-        parse_mode="Markdown",
+async def _send(bot, chat_id: int, text: str, buttons: list) -> bool:
+    await _wait_send_slot(chat_id)
+    msg = await send_message_with_gif(
+        bot,
+        chat_id,
+        "new_mail",
+        text,
+        reply_markup=InlineKeyboardMarkup(buttons) if buttons else None,
+        parse_mode="HTML",
     )
-    if not ok:
+    if msg is None:
         logger.warning("send_message failed")
-    return ok
+        return False
+    return True
 
 
-def run_sender_thread(msg_queue, bot_token: str):
-    """Background thread: drain queue and send messages."""
-    def worker():
-        while True:
+async def send_message(bot, chat_id: int, parsed: dict) -> bool:
+    """Send formatted message to Telegram."""
+    text = _format_message(parsed)
+    buttons = _build_buttons(parsed.get("urls", []), parsed.get("url_labels"))
+    return await _send(bot, chat_id, text, buttons)
+
+
+async def send_messages(bot, chat_id: int, parsed_list: list[dict]) -> bool:
+    """Send several mails for one chat as a single combined message (one pack_mails group)."""
+    if len(parsed_list) == 1:
+        return await send_message(bot, chat_id, parsed_list[0])
+    text = _MAIL_SEPARATOR.join(_format_message(p) for p in parsed_list)
+    buttons = []
+    for p in parsed_list:
+        buttons.extend(_build_buttons(p.get("urls", []), p.get("url_labels")))
+    return await _send(bot, chat_id, text, buttons)
+
+
+async def _send_chat(bot, user_id: int, items: list[dict], sem: asyncio.Semaphore) -> list[dict]:
+    """Deliver one chat's share of a batch, in order; return the mails that weren't sent."""
+    failed = []
+    async with sem:
+        for group in pack_mails(items):
             try:
-                user_id, parsed = msg_queue.get(timeout=2)
-                send_message_sync(bot_token, user_id, parsed)
-            except queue.Empty:
-                pass
+                if await send_messages(bot, user_id, group):
+                    continue
             except Exception as e:
-                logger.warning("Sender thread: %s", e)
-            time.sleep(0.3)
+                logger.warning("Sender task: %s", e)
+            failed.extend(group)
+    return failed
 
-    t = threading.Thread(target=worker, daemon=True)
-    t.start()
-    logger.info("Sender thread started")
+
+async def run_sender(msg_queue: asyncio.Queue, bot):
+    """Background task: drain queue in batches, one message per chat per batch."""
+    logger.info("Sender task started")
+    sem = asyncio.Semaphore(_MAX_PARALLEL_CHATS)
+    while True:
+        batch = [await msg_queue.get()]
+        while len(batch) < _MAX_BATCH and not msg_queue.empty():
+            batch.append(msg_queue.get_nowait())
+
+        by_user: dict[int, list[dict]] = {}
+        for user_id, parsed in batch:
+            by_user.setdefault(user_id, []).append(parsed)
+
+        # Chats don't depend on each other: send them concurrently, pacing keeps limits
+        results = await asyncio.gather(
+            *(_send_chat(bot, user_id, items, sem) for user_id, items in by_user.items())
+        )
+        # Release undelivered mails so the checker's next poll claims and sends them again
+        failed_ids = [p["id"] for failed in results for p in failed if p.get("id")]
+        if failed_ids:
+            logger.warning("Sender task: %d mail(s) not delivered, released: %s",
+                           len(failed_ids), ", ".join(failed_ids))
+            try:
+                await asyncio.to_thread(db.unmark_messages_seen, failed_ids)
+            except Exception as e:
+                logger.warning("Sender task: releasing %s failed: %s", failed_ids, e)
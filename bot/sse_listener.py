@@ -1,11 +1,14 @@
-"""Background mail checker: concurrent polling with expired-session filtering."""
+"""
+Background mail checker: one Mercure (SSE) stream task per active mailbox,
+with polling as catch-up on (re)connect and as fallback when a stream keeps failing.
+"""
+import asyncio
 import logging
-import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime, timezone
 
-from bot.mail_service import get_messages, get_message_detail
+import httpx
+
+from bot.mail_service import get_messages, get_message_detail, stream_account_events
 from bot.message_parser import parse_message
 import db
 from config import POLL_INTERVAL, SESSION_MAX_AGE_SECONDS, MAX_CONCURRENT_POLLS
@@ -14,15 +17,23 @@ logger = logging.getLogger(__name__)
 
 _CLEANUP_EVERY_N_CYCLES = 10
 
+_STREAM_RETRY_DELAYS = (1, 5, 15)  # reconnect waits before a stream falls back to polling
+_STREAM_RECONNECT_DELAY = 1        # after the server closes a healthy stream
+_STREAM_MIN_UPTIME = 30            # a stream that ends sooner counts as failed
+_STREAM_COOLDOWN = 600             # seconds a failed mailbox is polled before streaming again
+
+# account_id -> its stream task; a finished task means the stream gave up
+_streams: dict[str, asyncio.Task] = {}
+# account_id -> monotonic time its stream gave up
+_stream_failed_at: dict[str, float] = {}
+
+_MAX_POLL_BACKOFF = 120  # seconds between fallback polls of a mailbox that stays empty
+# account_id -> (monotonic time its next fallback poll is due, empty polls in a row)
+_poll_backoff: dict[str, tuple[float, int]] = {}
 
-def _is_expired(created_at: str) -> bool:
-    try:
-        dt = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return (datetime.now(timezone.utc) - dt).total_seconds() > SESSION_MAX_AGE_SECONDS
-    except Exception:
-        return True
+
+def _is_expired(created_at: int) -> bool:
+    return time.time() - created_at > SESSION_MAX_AGE_SECONDS
 
 
 def _adaptive_interval(session_count: int) -> float:
@@ -33,68 +44,212 @@ def _adaptive_interval(session_count: int) -> float:
     return 60
 
 
-def _check_new_messages(user_id: str, token: str, on_new) -> bool:
+async def _deliver_new(
+    user_id: int, token: str, messages: list[dict], out_queue: asyncio.Queue,
+) -> tuple[bool, bool]:
+    """Queue the listed mails nobody claimed yet; return (queued any, left any to retry)."""
+    # Most listed mails are already seen: filter with one read, then claim the rest at once.
+    # Both run off the loop: the claim waits on other workers' write locks (busy timeout)
+    ids = [m["id"] for m in messages if m.get("id")]
+    if not ids:
+        return False, False
+    seen = await asyncio.to_thread(db.get_seen_ids, ids)
+    new_ids = [i for i in ids if i not in seen]
+    if not new_ids:
+        return False, False
+    # The claim commits in its thread even if this task is cancelled meanwhile: shield
+    # it, and on cancellation wait for it and release what it took
+    claim = asyncio.ensure_future(asyncio.to_thread(db.claim_messages_seen, new_ids))
+    try:
+        claimed = set(await asyncio.shield(claim))
+    except asyncio.CancelledError:
+        await asyncio.to_thread(db.unmark_messages_seen, await claim)
+        raise
+
+    any_new = False
+    # Claimed but not yet queued: failed, or never reached if the task is cancelled
+    pending = [i for i in ids if i in claimed]
     try:
-        messages = get_messages(token)
+        for msg in messages:
+            msg_id = msg.get("id")
+            if msg_id not in claimed:
+                continue
+            try:
+                detail = await get_message_detail(token, msg_id)
+                parsed = parse_message(msg, detail)
+                await out_queue.put((user_id, parsed))
+                pending.remove(msg_id)
+                any_new = True
+            except Exception as e:
+                logger.warning("Failed to process message %s: %s", msg_id, e)
+    finally:
+        # Release them in one transaction so the next poll retries them; the thread
+        # finishes the release even if this task is cancelled while awaiting it
+        if pending:
+            await asyncio.to_thread(db.unmark_messages_seen, pending)
+    return any_new, bool(pending)
+
+
+async def _check_new_messages(user_id: int, token: str, out_queue: asyncio.Queue) -> tuple[bool, bool]:
+    try:
+        messages = await get_messages(token)
     except Exception as e:
         logger.warning("get_messages failed for user %s: %s", user_id, e)
-        return False
+        return False, True
+    return await _deliver_new(user_id, token, messages, out_queue)
 
-    any_new = False
-    for msg in messages:
-        msg_id = msg.get("id")
-        if not msg_id or not db.claim_message_seen(msg_id):
-            continue
+
+async def _poll(session: dict, out_queue: asyncio.Queue, sem: asyncio.Semaphore) -> tuple[bool, bool]:
+    """Check a mailbox once; return (queued any, left mail undelivered or listing failed)."""
+    async with sem:
         try:
-            detail = get_message_detail(token, msg_id)
-            parsed = parse_message(msg, detail)
-            on_new(user_id, msg_id, parsed)
-            any_new = True
+            return await _check_new_messages(session["user_id"], session["token"], out_queue)
         except Exception as e:
-            db.unmark_message_seen(msg_id)
-            logger.warning("Failed to process message %s: %s", msg_id, e)
-    return any_new
+            logger.warning("Poll error for %s: %s", session["user_id"], e)
+            return False, True
+
+
+async def _retry_poll(session: dict, out_queue: asyncio.Queue, sem: asyncio.Semaphore):
+    """Poll a streaming mailbox every POLL_INTERVAL until nothing is left undelivered."""
+    while True:
+        await asyncio.sleep(POLL_INTERVAL)
+        _, left = await _poll(session, out_queue, sem)
+        if not left:
+            return
+
 
+def _due_polls(to_poll: list[dict]) -> list[dict]:
+    """Fallback sessions whose backoff has run out (unknown ones are due at once)."""
+    now = time.monotonic()
+    accounts = {s["account_id"] for s in to_poll}
+    for account_id in [a for a in _poll_backoff if a not in accounts]:
+        del _poll_backoff[account_id]
+    return [s for s in to_poll if _poll_backoff.get(s["account_id"], (0.0, 0))[0] <= now]
 
-def run_mail_checker(on_new_message):
-    def worker():
-        cycle = 0
+
+def _schedule_poll(account_id: str, got_new: bool):
+    """Back off exponentially while a mailbox stays empty; poll at full rate after a hit."""
+    idle = 0 if got_new else _poll_backoff.get(account_id, (0.0, 0))[1] + 1
+    delay = min(_MAX_POLL_BACKOFF, POLL_INTERVAL * 2 ** min(idle, 8))
+    # Due slightly early so a poll isn't pushed back a whole cycle by jitter
+    _poll_backoff[account_id] = (time.monotonic() + delay - 1, idle)
+
+
+async def _stream_mailbox(session: dict, out_queue: asyncio.Queue, sem: asyncio.Semaphore):
+    """Deliver a mailbox's mail as Mercure pushes it; return once reconnects keep failing."""
+    user_id, token, account_id = session["user_id"], session["token"], session["account_id"]
+    failures = 0
+    last_event_id = None
+    # Re-polls mail a failed delivery left behind; a live stream won't push it again
+    retry: asyncio.Task | None = None
+
+    def schedule_retry():
+        nonlocal retry
+        if retry is None or retry.done():
+            retry = asyncio.create_task(_retry_poll(session, out_queue, sem))
+
+    try:
+        while True:
+            # Catch up on anything that arrived while we weren't listening (the hub
+            # replays from last_event_id only if it keeps history)
+            _, left = await _poll(session, out_queue, sem)
+            if left:
+                schedule_retry()
+            opened = time.monotonic()
+            try:
+                async for event_id, event in stream_account_events(token, account_id, last_event_id):
+                    last_event_id = event_id or last_event_id
+                    if event.get("@type") == "Message" and event.get("id"):
+                        _, left = await _deliver_new(user_id, token, [event], out_queue)
+                        if left:
+                            schedule_retry()
+                if time.monotonic() - opened < _STREAM_MIN_UPTIME:
+                    # Otherwise a hub that closes at once gets reconnected (and polled) every second
+                    raise ConnectionError("stream closed right after opening")
+                failures, delay = 0, _STREAM_RECONNECT_DELAY
+            except httpx.ReadTimeout:
+                # Nothing pushed for a while; just reopen
+                failures, delay = 0, _STREAM_RECONNECT_DELAY
+            except Exception as e:
+                if time.monotonic() - opened >= _STREAM_MIN_UPTIME:
+                    failures = 0  # it was healthy until now
+                if failures >= len(_STREAM_RETRY_DELAYS):
+                    logger.warning("Mercure stream for user %s gave up, polling instead: %s", user_id, e)
+                    return
+                delay = _STREAM_RETRY_DELAYS[failures]
+                failures += 1
+                logger.info("Mercure stream for user %s dropped, reconnect in %ds: %s", user_id, delay, e)
+            await asyncio.sleep(delay)
+    finally:
+        # Fallback polling (or a new stream) takes over from here
+        if retry is not None:
+            retry.cancel()
+
+
+def _sync_streams(active: list[dict], out_queue: asyncio.Queue, sem: asyncio.Semaphore) -> list[dict]:
+    """Start/stop stream tasks to match active sessions; return the sessions to poll."""
+    now = time.monotonic()
+    wanted = {s["account_id"]: s for s in active}
+    for account_id, task in list(_streams.items()):
+        if account_id not in wanted:
+            task.cancel()
+            del _streams[account_id]
+        elif task.done():
+            del _streams[account_id]
+            _stream_failed_at[account_id] = now
+    for account_id in [a for a in _stream_failed_at if a not in wanted]:
+        del _stream_failed_at[account_id]
+
+    to_poll = []
+    for account_id, session in wanted.items():
+        if account_id in _streams:
+            continue
+        failed_at = _stream_failed_at.get(account_id)
+        if failed_at is not None and now - failed_at < _STREAM_COOLDOWN:
+            to_poll.append(session)
+            continue
+        _stream_failed_at.pop(account_id, None)
+        _streams[account_id] = asyncio.create_task(_stream_mailbox(session, out_queue, sem))
+    return to_poll
+
+
+async def run_mail_checker(out_queue: asyncio.Queue):
+    """Background task on the bot loop: watch active sessions, put (user_id, parsed) on out_queue."""
+    logger.info("Mail checker task started (sync interval: %ds, max concurrent polls: %d)",
+                POLL_INTERVAL, MAX_CONCURRENT_POLLS)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_POLLS)
+    loop = asyncio.get_running_loop()
+    cycle = 0
+    try:
         while True:
             cycle += 1
-            sessions = db.get_all_sessions()
+            # Interval counts from the cycle's start, so slow polls don't stretch it
+            started = loop.time()
+            # Whole-table reads and the periodic DELETEs can take a while: keep them off the loop
+            sessions = await asyncio.to_thread(db.get_all_sessions)
             active = [s for s in sessions if not _is_expired(s["created_at"])]
 
             if cycle % _CLEANUP_EVERY_N_CYCLES == 0:
-                db.cleanup_expired_sessions()
-                db.cleanup_old_messages()
+                await asyncio.to_thread(db.cleanup_expired_sessions)
+                await asyncio.to_thread(db.cleanup_old_messages)
 
-            if not active:
-                time.sleep(POLL_INTERVAL)
+            # New sessions get a stream within one interval; ended ones lose theirs
+            to_poll = _sync_streams(active, out_queue, sem)
+            if not to_poll:
+                await asyncio.sleep(max(0.0, started + POLL_INTERVAL - loop.time()))
                 continue
 
-            logger.info("Polling %d active sessions (skipped %d expired)",
-                        len(active), len(sessions) - len(active))
-
-            with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_POLLS, len(active))) as pool:
-                futures = {
-                    pool.submit(
-                        _check_new_messages,
-                        s["user_id"],
-                        s["token"],
-                        on_new_message,
-                    ): s["user_id"]
-                    for s in active
-                }
-                for fut in as_completed(futures):
-                    try:
-                        fut.result()
-                    except Exception as e:
-                        logger.warning("Poll error for %s: %s", futures[fut], e)
-
-            interval = _adaptive_interval(len(active))
-            time.sleep(interval)
-
-    t = threading.Thread(target=worker, daemon=True)
-    t.start()
-    logger.info("Mail checker thread started (poll interval: %ds, max workers: %d)",
-                POLL_INTERVAL, MAX_CONCURRENT_POLLS)
+            due = _due_polls(to_poll)
+            logger.info("Polling %d of %d sessions without a stream (%d streaming)",
+                        len(due), len(to_poll), len(_streams))
+
+            results = await asyncio.gather(*(_poll(s, out_queue, sem) for s in due))
+            for session, (got_new, _) in zip(due, results):
+                _schedule_poll(session["account_id"], got_new)
+
+            interval = _adaptive_interval(len(to_poll))
+            await asyncio.sleep(max(0.0, started + interval - loop.time()))
+    finally:
+        for task in _streams.values():
+            task.cancel()
+        _streams.clear()
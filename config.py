@@ -5,8 +5,13 @@ import uuid
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
 WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "") or uuid.uuid4().hex
+# Whether this process takes part in set_webhook (one worker per run does it, via a DB lease)
+WEBHOOK_REGISTER = os.environ.get("WEBHOOK_REGISTER", "1") != "0"
 PORT = int(os.environ.get("PORT", 8080))
 
+# Max updates processed concurrently per worker (one chat is still processed in order)
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 32))
+
 MAIL_TM_BASE = "https://api.mail.tm"
 MAIL_TM_MERCURE = "https://mercure.mail.tm/.well-known/mercure"
 
@@ -24,10 +29,12 @@ RETRY_BACKOFF = [1, 2, 4]  # seconds
 # Max inline buttons per row (Telegram limit ~8, keep lower for readability)
 MAX_LINKS_PER_MESSAGE = 5
 
-# Rate limits (per user)
-RATE_LIMIT_CREATE = 3        # max email creations per hour
-RATE_LIMIT_REFRESH = 10      # max refreshes per minute
-RATE_LIMIT_GENERAL = 20      # max other actions per minute
+# Rate limits (per user), as token buckets: each value is the burst size, and the
+# bucket refills at that many per window. So the most allowed in any one window is
+# just under twice the value (a full burst, then the refill), e.g. 5 creations an hour.
+RATE_LIMIT_CREATE = 3        # email creations: burst of 3, +3 per hour
+RATE_LIMIT_REFRESH = 10      # refreshes: burst of 10, +10 per minute
+RATE_LIMIT_GENERAL = 20      # other actions: burst of 20, +20 per minute
 
 # GIF style config (Telegram file_id-based)
 GIF_DEFAULT_FILE_ID = os.environ.get("GIF_DEFAULT_FILE_ID", "")
@@ -35,28 +42,23 @@ GIF_DEFAULT_URL = os.environ.get(
     "GIF_DEFAULT_URL",
     "https://media.giphy.com/media/ICOgUNjpvO0PC/giphy.gif",
 )
+# tag -> default GIF URL; each tag can be overridden with GIF_<TAG>_URL / GIF_<TAG>_FILE_ID
+_GIF_DEFAULT_URLS = {
+    "start": "https://media.giphy.com/media/ICOgUNjpvO0PC/giphy.gif",
+    "create_success": "https://media.giphy.com/media/l0MYt5jPR6QX5pnqM/giphy.gif",
+    "create_error": "https://media.giphy.com/media/3o7abB06u9bNzA8lu8/giphy.gif",
+    "refresh": "https://media.giphy.com/media/26ufdipQqU2lhNA4g/giphy.gif",
+    "no_mail": "https://media.giphy.com/media/3oriO0OEd9QIDdllqo/giphy.gif",
+    "new_mail": "https://media.giphy.com/media/5GoVLqeAOo6PK/giphy.gif",
+    "expired": "https://media.giphy.com/media/fAnEC88LccN7a/giphy.gif",
+    "rate_limited": "https://media.giphy.com/media/26xBI73gWquCBBCDe/giphy.gif",
+    "delete_success": "https://media.giphy.com/media/10hO3rDNqqg2Xe/giphy.gif",
+    "generic_error": "https://media.giphy.com/media/3o7btPCcdNniyf0ArS/giphy.gif",
+    "my_mail": "https://media.giphy.com/media/l0HlGdXFWYbKv5rby/giphy.gif",
+}
 GIF_URLS = {
-    "start": os.environ.get("GIF_START_URL", "https://media.giphy.com/media/ICOgUNjpvO0PC/giphy.gif"),
-    "create_success": os.environ.get("GIF_CREATE_SUCCESS_URL", "https://media.giphy.com/media/l0MYt5jPR6QX5pnqM/giphy.gif"),
-    "create_error": os.environ.get("GIF_CREATE_ERROR_URL", "https://media.giphy.com/media/3o7abB06u9bNzA8lu8/giphy.gif"),
-    "refresh": os.environ.get("GIF_REFRESH_URL", "https://media.giphy.com/media/26ufdipQqU2lhNA4g/giphy.gif"),
-    "no_mail": os.environ.get("GIF_NO_MAIL_URL", "https://media.giphy.com/media/3oriO0OEd9QIDdllqo/giphy.gif"),
-    "new_mail": os.environ.get("GIF_NEW_MAIL_URL", "https://media.giphy.com/media/5GoVLqeAOo6PK/giphy.gif"),
-    "expired": os.environ.get("GIF_EXPIRED_URL", "https://media.giphy.com/media/fAnEC88LccN7a/giphy.gif"),
-    "rate_limited": os.environ.get("GIF_RATE_LIMITED_URL", "https://media.giphy.com/media/26xBI73gWquCBBCDe/giphy.gif"),
-    "delete_success": os.environ.get("GIF_DELETE_SUCCESS_URL", "https://media.giphy.com/media/10hO3rDNqqg2Xe/giphy.gif"),
-    "generic_error": os.environ.get("GIF_GENERIC_ERROR_URL", "https://media.giphy.com/media/3o7btPCcdNniyf0ArS/giphy.gif"),
-    "my_mail": os.environ.get("GIF_MY_MAIL_URL", "https://media.giphy.com/media/l0HlGdXFWYbKv5rby/giphy.gif"),
+    tag: os.environ.get(f"GIF_{tag.upper()}_URL", url) for tag, url in _GIF_DEFAULT_URLS.items()
 }
 GIF_FILE_IDS = {
-    "start": os.environ.get("GIF_START_FILE_ID", ""),
-    "create_success": os.environ.get("GIF_CREATE_SUCCESS_FILE_ID", ""),
-    "create_error": os.environ.get("GIF_CREATE_ERROR_FILE_ID", ""),
-    "refresh": os.environ.get("GIF_REFRESH_FILE_ID", ""),
-    "no_mail": os.environ.get("GIF_NO_MAIL_FILE_ID", ""),
-    "new_mail": os.environ.get("GIF_NEW_MAIL_FILE_ID", ""),
-    "expired": os.environ.get("GIF_EXPIRED_FILE_ID", ""),
-    "rate_limited": os.environ.get("GIF_RATE_LIMITED_FILE_ID", ""),
-    "delete_success": os.environ.get("GIF_DELETE_SUCCESS_FILE_ID", ""),
-    "generic_error": os.environ.get("GIF_GENERIC_ERROR_FILE_ID", ""),
+    tag: os.environ.get(f"GIF_{tag.upper()}_FILE_ID", "") for tag in _GIF_DEFAULT_URLS
 }
@@ -1,77 +1,213 @@
 """SQLite database for sessions and seen messages."""
+import os
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from datetime import datetime, timezone, timedelta
 
 from config import SESSION_MAX_AGE_SECONDS
 
 DB_PATH = Path(__file__).parent / "data" / "bot.db"
 
+# Recently seen message ids, LRU-bounded. Seen is final (only a failed send
+# unmarks, and that evicts here too), so a hit can skip SQLite entirely.
+_SEEN_CACHE_SIZE = 50_000  # ~30 listed ids per mailbox, so room for ~1.6k busy inboxes
+_seen_cache: OrderedDict[str, None] = OrderedDict()
+_seen_lock = threading.Lock()
+
+# (sessions_version, rows) from the last full get_all_sessions read
+_sessions_cache: tuple[int, list[dict]] | None = None
+
+_IN_CHUNK = 500  # ids per "IN (...)" query
+
 
 def _ensure_db_dir():
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 
-def get_connection():
-    _ensure_db_dir()
-    conn = sqlite3.connect(str(DB_PATH), timeout=10)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
+# One long-lived connection per thread (the event loop and the to_thread workers)
+_local = threading.local()
+
+
+def get_connection() -> sqlite3.Connection:
+    """This thread's connection, opened and tuned on first use."""
+    conn = getattr(_local, "conn", None)
+    # A connection inherited across fork belongs to the parent: never reuse it
+    if conn is None or _local.pid != os.getpid():
+        _ensure_db_dir()
+        conn = sqlite3.connect(str(DB_PATH), timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent; fsync only at checkpoints
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")  # 64 MB page cache, allocated as used
+        conn.execute("PRAGMA mmap_size=268435456")
+        # Checkpoints keep the default 1000-page cadence; truncate the WAL file back after them
+        conn.execute("PRAGMA journal_size_limit=67108864")
+        _local.conn, _local.pid = conn, os.getpid()
     return conn
 
 
+def _release(conn: sqlite3.Connection):
+    """Finish with the shared connection: roll back anything a failed call left open."""
+    if conn.in_transaction:
+        conn.rollback()
+
+
 def init_db():
     conn = get_connection()
     try:
         conn.executescript("""
             CREATE TABLE IF NOT EXISTS sessions (
-                user_id TEXT PRIMARY KEY,
+                user_id INTEGER PRIMARY KEY,
                 email TEXT NOT NULL,
                 token TEXT NOT NULL,
                 account_id TEXT NOT NULL,
-                created_at TEXT NOT NULL
+                created_at INTEGER NOT NULL
             );
 
             CREATE TABLE IF NOT EXISTS messages_seen (
                 message_id TEXT PRIMARY KEY,
-                seen_at TEXT NOT NULL DEFAULT ''
+                seen_at INTEGER NOT NULL DEFAULT 0
             );
 
             CREATE TABLE IF NOT EXISTS ui_state (
-                user_id TEXT PRIMARY KEY,
+                user_id INTEGER PRIMARY KEY,
                 last_message_id INTEGER NOT NULL
             );
+
+            CREATE TABLE IF NOT EXISTS gif_cache (
+                ref TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS webhook_registration (
+                run_id TEXT PRIMARY KEY,
+                owner INTEGER NOT NULL,
+                expires_at INTEGER NOT NULL,
+                status TEXT NOT NULL
+            );
         """)
         conn.commit()
         _migrate(conn)
+        # After _migrate: rebuilding a table drops its indexes and triggers
+        conn.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_sessions_created ON sessions(created_at);
+            CREATE INDEX IF NOT EXISTS idx_messages_seen_seen_at ON messages_seen(seen_at);
+
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('sessions_version', 0);
+
+            CREATE TRIGGER IF NOT EXISTS sessions_version_insert AFTER INSERT ON sessions
+            BEGIN UPDATE meta SET value = value + 1 WHERE key = 'sessions_version'; END;
+            CREATE TRIGGER IF NOT EXISTS sessions_version_update AFTER UPDATE ON sessions
+            BEGIN UPDATE meta SET value = value + 1 WHERE key = 'sessions_version'; END;
+            CREATE TRIGGER IF NOT EXISTS sessions_version_delete AFTER DELETE ON sessions
+            BEGIN UPDATE meta SET value = value + 1 WHERE key = 'sessions_version'; END;
+        """)
+        conn.commit()
         cleanup_expired_sessions(conn)
         cleanup_old_messages(conn)
+        _warm_seen_cache(conn)
     finally:
-        conn.close()
+        _release(conn)
 
 
 def _migrate(conn: sqlite3.Connection):
-    """Add seen_at column if missing (migration from older schema)."""
+    """Bring databases created by older versions up to the current schema."""
     cols = [row[1] for row in conn.execute("PRAGMA table_info(messages_seen)").fetchall()]
     if "seen_at" not in cols:
         conn.execute("ALTER TABLE messages_seen ADD COLUMN seen_at TEXT NOT NULL DEFAULT ''")
         conn.commit()
+    _retype_column(conn, "sessions", "user_id", "INTEGER", "CAST(user_id AS INTEGER)")
+    _retype_column(conn, "ui_state", "user_id", "INTEGER", "CAST(user_id AS INTEGER)")
+    # ISO timestamps -> unix seconds; unparseable values become 0 (expired)
+    _retype_column(
+        conn, "sessions", "created_at", "INTEGER",
+        "COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)",
+    )
+    # Same for seen markers; undated ('') ones count from now so they still age out
+    _retype_column(
+        conn, "messages_seen", "seen_at", "INTEGER",
+        "COALESCE(CAST(strftime('%s', seen_at) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))",
+        default="0",
+    )
+
+
+def _column_info(conn: sqlite3.Connection, table: str, column: str) -> tuple[str, str | None] | None:
+    """(declared type, DEFAULT expression) of a column, or None if it doesn't exist."""
+    for row in conn.execute(f"PRAGMA table_info({table})").fetchall():
+        if row[1] == column:
+            return row[2].upper(), row[4]
+    return None
+
+
+def _retype_column(
+    conn: sqlite3.Connection, table: str, column: str, new_type: str, convert_sql: str,
+    default: str | None = None,
+):
+    """
+    Rebuild a table so `column` gets `new_type`, and `default` as its DEFAULT
+    if given (SQLite can't ALTER a column's type or default).
+    """
+    def is_current(info):
+        return info is None or (info[0] == new_type and (default is None or info[1] == default))
+
+    if is_current(_column_info(conn, table, column)):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Re-check under the write lock: another worker may have migrated already
+        if is_current(_column_info(conn, table, column)):
+            conn.rollback()
+            return
+        schema = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()[0]
+
+        def column_def(m: re.Match) -> str:
+            constraints = m.group(1).rstrip()
+            trailing = m.group(1)[len(constraints):]  # newline/indent before ")"
+            if default is not None:
+                constraints = re.sub(r"\s+DEFAULT\s+('[^']*'|[^\s,)]+)", "", constraints)
+                constraints += f" DEFAULT {default}"
+            return f"{column} {new_type}{constraints}{trailing}"
+
+        new_schema = re.sub(rf"\b{column}\s+\w+([^,)]*)", column_def, schema, count=1)
+        conn.execute(new_schema.replace(table, f"{table}_new", 1))
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        select = ", ".join(convert_sql if c == column else c for c in columns)
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table}_new ({', '.join(columns)}) "
+            f"SELECT {select} FROM {table}"
+        )
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 
-def save_session(user_id: str, email: str, token: str, account_id: str):
+def save_session(user_id: int, email: str, token: str, account_id: str):
     conn = get_connection()
     try:
         conn.execute(
             "INSERT OR REPLACE INTO sessions (user_id, email, token, account_id, created_at) "
             "VALUES (?, ?, ?, ?, ?)",
-            (user_id, email, token, account_id, datetime.now(timezone.utc).isoformat()),
+            (user_id, email, token, account_id, int(time.time())),
         )
         conn.commit()
     finally:
-        conn.close()
+        _release(conn)
 
 
-def get_session(user_id: str) -> dict | None:
+def get_session(user_id: int) -> dict | None:
     conn = get_connection()
     try:
         row = conn.execute(
@@ -80,81 +216,142 @@ def get_session(user_id: str) -> dict | None:
         ).fetchone()
         return dict(row) if row else None
     finally:
-        conn.close()
+        _release(conn)
 
 
-def delete_session(user_id: str):
+def delete_session(user_id: int):
     conn = get_connection()
     try:
         conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
         conn.commit()
     finally:
-        conn.close()
-
-
-def is_message_seen(message_id: str) -> bool:
-    conn = get_connection()
-    try:
-        row = conn.execute(
-            "SELECT 1 FROM messages_seen WHERE message_id = ?",
-            (message_id,),
-        ).fetchone()
-        return row is not None
-    finally:
-        conn.close()
-
-
-def mark_message_seen(message_id: str):
+        _release(conn)
+
+
+def _remember_seen(message_ids):
+    with _seen_lock:
+        for message_id in message_ids:
+            _seen_cache[message_id] = None
+            _seen_cache.move_to_end(message_id)
+        while len(_seen_cache) > _SEEN_CACHE_SIZE:
+            _seen_cache.popitem(last=False)
+
+
+def _forget_seen(message_ids):
+    with _seen_lock:
+        for message_id in message_ids:
+            _seen_cache.pop(message_id, None)
+
+
+def _warm_seen_cache(conn: sqlite3.Connection):
+    """Preload the newest seen ids so the catch-up polls after a restart skip SQLite."""
+    rows = conn.execute(
+        "SELECT message_id FROM ("
+        "  SELECT message_id, seen_at FROM messages_seen ORDER BY seen_at DESC LIMIT ?"
+        ") ORDER BY seen_at",
+        (_SEEN_CACHE_SIZE,),
+    ).fetchall()
+    _remember_seen(r["message_id"] for r in rows)
+
+
+def get_seen_ids(message_ids: list[str]) -> set[str]:
+    """Return the subset of message_ids already marked seen (one query per 500 cache misses)."""
+    with _seen_lock:
+        seen = set()
+        for message_id in message_ids:
+            if message_id in _seen_cache:
+                _seen_cache.move_to_end(message_id)
+                seen.add(message_id)
+    misses = [message_id for message_id in message_ids if message_id not in seen]
+    if not misses:
+        return seen
     conn = get_connection()
+    found = []
     try:
-        conn.execute(
-            "INSERT OR IGNORE INTO messages_seen (message_id, seen_at) VALUES (?, ?)",
-            (message_id, datetime.now(timezone.utc).isoformat()),
-        )
-        conn.commit()
+        # Chunked to stay under SQLite's bound-parameter limit on older builds (999)
+        for i in range(0, len(misses), _IN_CHUNK):
+            chunk = misses[i:i + _IN_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT message_id FROM messages_seen WHERE message_id IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            found.extend(r["message_id"] for r in rows)
     finally:
-        conn.close()
+        _release(conn)
+    _remember_seen(found)
+    seen.update(found)
+    return seen
 
 
-def claim_message_seen(message_id: str) -> bool:
+def claim_messages_seen(message_ids: list[str]) -> list[str]:
     """
-    Atomically claim a message for processing.
-    Returns True only for the first caller.
+    Atomically claim several messages in one transaction.
+    Returns the ids this caller claimed first, in input order.
     """
+    if not message_ids:
+        return []
     conn = get_connection()
     try:
-        cur = conn.execute(
-            "INSERT OR IGNORE INTO messages_seen (message_id, seen_at) VALUES (?, ?)",
-            (message_id, datetime.now(timezone.utc).isoformat()),
-        )
+        now = int(time.time())
+        claimed = [
+            message_id
+            for message_id in message_ids
+            if conn.execute(
+                "INSERT OR IGNORE INTO messages_seen (message_id, seen_at) VALUES (?, ?)",
+                (message_id, now),
+            ).rowcount == 1
+        ]
         conn.commit()
-        return cur.rowcount == 1
     finally:
-        conn.close()
+        _release(conn)
+    # Every id is seen now, whether this caller or another one claimed it
+    _remember_seen(message_ids)
+    return claimed
 
 
-def unmark_message_seen(message_id: str):
-    """Remove seen marker (used when processing failed after claim)."""
+def unmark_messages_seen(message_ids: list[str]):
+    """Remove seen markers for several messages in one transaction."""
+    if not message_ids:
+        return
+    _forget_seen(message_ids)
     conn = get_connection()
     try:
-        conn.execute("DELETE FROM messages_seen WHERE message_id = ?", (message_id,))
+        conn.executemany(
+            "DELETE FROM messages_seen WHERE message_id = ?",
+            [(message_id,) for message_id in message_ids],
+        )
         conn.commit()
     finally:
-        conn.close()
+        _release(conn)
 
 
 def get_all_sessions() -> list[dict]:
+    """
+    All sessions, re-read only when the trigger-maintained version moved
+    (any worker's write bumps it). The list is shared: treat it as read-only.
+    """
+    global _sessions_cache
     conn = get_connection()
     try:
+        # Version first: rows read after it are at least that new
+        version = conn.execute(
+            "SELECT value FROM meta WHERE key = 'sessions_version'"
+        ).fetchone()[0]
+        cached = _sessions_cache
+        if cached is not None and cached[0] == version:
+            return cached[1]
         rows = conn.execute(
             "SELECT user_id, email, token, account_id, created_at FROM sessions"
         ).fetchall()
-        return [dict(r) for r in rows]
+        sessions = [dict(r) for r in rows]
+        _sessions_cache = (version, sessions)
+        return sessions
     finally:
-        conn.close()
+        _release(conn)
 
 
-def get_last_ui_message_id(user_id: str) -> int | None:
+def get_last_ui_message_id(user_id: int) -> int | None:
     conn = get_connection()
     try:
         row = conn.execute(
@@ -163,10 +360,10 @@ def get_last_ui_message_id(user_id: str) -> int | None:
         ).fetchone()
         return int(row["last_message_id"]) if row else None
     finally:
-        conn.close()
+        _release(conn)
 
 
-def set_last_ui_message_id(user_id: str, message_id: int):
+def set_last_ui_message_id(user_id: int, message_id: int):
     conn = get_connection()
     try:
         conn.execute(
@@ -175,16 +372,88 @@ def set_last_ui_message_id(user_id: str, message_id: int):
         )
         conn.commit()
     finally:
-        conn.close()
+        _release(conn)
 
 
-def clear_last_ui_message_id(user_id: str):
+def clear_last_ui_message_id(user_id: int):
     conn = get_connection()
     try:
         conn.execute("DELETE FROM ui_state WHERE user_id = ?", (user_id,))
         conn.commit()
     finally:
-        conn.close()
+        _release(conn)
+
+
+def get_gif_file_ids() -> dict[str, str]:
+    conn = get_connection()
+    try:
+        rows = conn.execute("SELECT ref, file_id FROM gif_cache").fetchall()
+        return {r["ref"]: r["file_id"] for r in rows}
+    finally:
+        _release(conn)
+
+
+def save_gif_file_id(ref: str, file_id: str):
+    conn = get_connection()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO gif_cache (ref, file_id) VALUES (?, ?)",
+            (ref, file_id),
+        )
+        conn.commit()
+    finally:
+        _release(conn)
+
+
+def delete_gif_file_id(ref: str):
+    conn = get_connection()
+    try:
+        conn.execute("DELETE FROM gif_cache WHERE ref = ?", (ref,))
+        conn.commit()
+    finally:
+        _release(conn)
+
+
+# ── Webhook registration ───────────────────────────────────────────
+
+
+def claim_webhook_registration(run_id: str, owner: int, ttl: int) -> str:
+    """
+    Take or renew the lease to register this run's webhook. Returns "claimed"
+    (owner holds it), "pending" (another live worker does), "done" or "failed".
+    A lease its owner stops renewing expires after ttl seconds.
+    """
+    conn = get_connection()
+    try:
+        now = int(time.time())
+        conn.execute("DELETE FROM webhook_registration WHERE run_id != ?", (run_id,))
+        claimed = conn.execute(
+            "INSERT INTO webhook_registration (run_id, owner, expires_at, status) "
+            "VALUES (?, ?, ?, 'pending') "
+            "ON CONFLICT(run_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE status = 'pending' AND (owner = excluded.owner OR expires_at < ?)",
+            (run_id, owner, now + ttl, now),
+        ).rowcount == 1
+        status = "claimed" if claimed else conn.execute(
+            "SELECT status FROM webhook_registration WHERE run_id = ?", (run_id,)
+        ).fetchone()["status"]
+        conn.commit()
+        return status
+    finally:
+        _release(conn)
+
+
+def finish_webhook_registration(run_id: str, status: str):
+    """Record the outcome ("done" or "failed") so no other worker registers this run again."""
+    conn = get_connection()
+    try:
+        conn.execute(
+            "UPDATE webhook_registration SET status = ? WHERE run_id = ?",
+            (status, run_id),
+        )
+        conn.commit()
+    finally:
+        _release(conn)
 
 
 # ── Cleanup ────────────────────────────────────────────────────────
@@ -195,7 +464,7 @@ def cleanup_expired_sessions(conn: sqlite3.Connection | None = None):
     if own:
         conn = get_connection()
     try:
-        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=SESSION_MAX_AGE_SECONDS)).isoformat()
+        cutoff = int(time.time()) - SESSION_MAX_AGE_SECONDS
         deleted = conn.execute(
             "DELETE FROM sessions WHERE created_at < ?", (cutoff,)
         ).rowcount
@@ -205,7 +474,7 @@ def cleanup_expired_sessions(conn: sqlite3.Connection | None = None):
             getLogger(__name__).info("Cleaned up %d expired sessions", deleted)
     finally:
         if own:
-            conn.close()
+            _release(conn)
 
 
 def cleanup_old_messages(conn: sqlite3.Connection | None = None, days: int = 7):
@@ -214,14 +483,16 @@ def cleanup_old_messages(conn: sqlite3.Connection | None = None, days: int = 7):
     if own:
         conn = get_connection()
     try:
-        cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+        cutoff = int(time.time()) - days * 86400
         deleted = conn.execute(
-            "DELETE FROM messages_seen WHERE seen_at != '' AND seen_at < ?", (cutoff,)
+            "DELETE FROM messages_seen WHERE seen_at < ?", (cutoff,)
         ).rowcount
         conn.commit()
+        # Refresh planner stats after bulk deletes (a no-op unless they're stale)
+        conn.execute("PRAGMA optimize")
         if deleted:
             from logging import getLogger
             getLogger(__name__).info("Cleaned up %d old message records", deleted)
     finally:
         if own:
-            conn.close()
+            _release(conn)
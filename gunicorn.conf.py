@@ -1,12 +1,25 @@
 """Gunicorn production config for Railway."""
 import os
+import uuid
 
 bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
-workers = 2
+# Each worker is an event loop handling many requests at once, but also runs its own
+# mail checker and Mercure streams: scale via WEB_CONCURRENCY, not CPU count
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "aiohttp.GunicornWebWorker"
+worker_tmp_dir = "/dev/shm"
 timeout = 60
 max_requests = 1000
 max_requests_jitter = 50
-preload_app = False
+# Import the app once in the master; workers share its pages copy-on-write.
+# Nothing at import opens sockets or DB handles (both are per worker, lazily).
+preload_app = True
 accesslog = "-"
 errorlog = "-"
 loglevel = "info"
+
+# Workers must all accept the secret whichever worker registers sends Telegram.
+# Set while this file loads, before the preloaded app imports config.
+if not os.environ.get("WEBHOOK_SECRET"):
+    os.environ["WEBHOOK_SECRET"] = uuid.uuid4().hex
+